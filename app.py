@@ -1,17 +1,58 @@
 import os
-import json
+import gzip
+import time
+import hashlib
 import uuid
-import threading
-from flask import Flask, render_template, request, jsonify
+import orjson
+import tempfile
+from functools import lru_cache, wraps
+from flask import Flask, Request, render_template, request, jsonify, send_file
 from flask_cors import CORS
 from dotenv import load_dotenv
-from database import get_db, init_db
-from services.ocr_service import process_document_ocr
-from services.extraction_service import extract_document_financials
+from database import get_db, init_db, on_document_write, release_db
+from services.ocr_service import submit_extraction, submit_ocr
 
 load_dotenv()
 
+
+# Mode a regular open() would create files with. Read once at import (os.umask
+# can only be queried by setting it, which isn't safe once threads run).
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+UPLOAD_FILE_MODE = 0o666 & ~_UMASK
+
+
+class UploadRequest(Request):
+    """Request that spools multipart file parts straight into UPLOAD_FOLDER.
+
+    Werkzeug normally buffers parts in memory or the system temp dir, and
+    file.save() then copies them again; landing them beside their final
+    path lets upload() move each file into place with a rename.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._spooled = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_FOLDER, prefix='.upload-', delete=False)
+        self._spooled.append(spool.name)
+        # mkstemp creates 0600; give stored uploads the umask-derived mode file.save() produced
+        os.chmod(spool.name, UPLOAD_FILE_MODE)
+        return spool
+
+    def close(self):
+        super().close()
+        # Remove any parts the view did not move into place
+        for path in self._spooled:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key')
 CORS(app)
 
@@ -24,6 +65,64 @@ MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE_MB', 50)) * 1024 * 1024
 init_db()
 
 
+@app.teardown_appcontext
+def _release_db(exc):
+    release_db()
+
+
+# ---------- Response Cache ----------
+
+# endpoint name -> (expires_at, response body)
+_cache = {}
+
+
+def _cached(ttl):
+    """Serve a JSON view from memory for `ttl` seconds, keyed by endpoint name."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = view.__name__
+            entry = _cache.get(key)
+            now = time.monotonic()
+            if entry and entry[0] > now:
+                return app.response_class(entry[1], mimetype='application/json')
+            response = view(*args, **kwargs)
+            _cache[key] = (now + ttl, response.get_data())
+            return response
+        return wrapper
+    return decorator
+
+
+def _invalidate(*keys):
+    """Drop cached responses for the given endpoints."""
+    for key in keys:
+        _cache.pop(key, None)
+
+
+def _json_response(obj, status=200):
+    """Serialize a payload with orjson; jsonify's stdlib encoder dominates large responses."""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+# Background OCR/extraction updates change the dashboard tiles
+on_document_write(lambda: _invalidate('dashboard'))
+
+
+@lru_cache(maxsize=256)
+def _load_json_cached(path, mtime_ns):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def _load_json(path):
+    """Parse a JSON file, reusing the previous parse until its mtime changes.
+
+    Callers share the returned object and must not mutate it.
+    """
+    return _load_json_cached(path, os.stat(path).st_mtime_ns)
+
+
 # ---------- Serve Frontend ----------
 
 @app.route('/')
@@ -34,39 +133,34 @@ def index():
 # ---------- Dashboard API ----------
 
 @app.route('/api/dashboard')
+@_cached(ttl=5)
 def dashboard():
     conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute('SELECT COUNT(*) as total FROM documents')
-    total = cursor.fetchone()['total']
-
-    cursor.execute("SELECT COUNT(*) as count FROM documents WHERE ocr_status = 'completed'")
-    analyzed = cursor.fetchone()['count']
-
-    cursor.execute("SELECT COUNT(*) as count FROM documents WHERE ocr_status IN ('pending', 'processing')")
-    pending = cursor.fetchone()['count']
-
-    cursor.execute("SELECT COUNT(*) as count FROM documents WHERE ocr_status = 'failed'")
-    failed = cursor.fetchone()['count']
-
-    cursor.execute('SELECT AVG(ocr_confidence) as avg_conf FROM documents WHERE ocr_confidence > 0')
-    row = cursor.fetchone()
-    accuracy = round((row['avg_conf'] or 0) * 100, 1)
-
-    cursor.execute("SELECT COUNT(*) as count FROM documents WHERE extraction_status = 'completed'")
-    fully_analyzed = cursor.fetchone()['count']
-
-    cursor.execute('SELECT AVG(confidence_score) as avg_conf FROM documents WHERE confidence_score > 0')
-    row = cursor.fetchone()
-    avg_extraction_confidence = round((row['avg_conf'] or 0) * 100, 1)
-
-    cursor.execute('SELECT AVG(entry_multiple) as avg_mult FROM documents WHERE entry_multiple IS NOT NULL')
+    # All tile aggregates in one scan; AVG ignores the NULLs produced by unmatched CASEs
+    cursor.execute('''
+        SELECT
+            COUNT(*) AS total,
+            SUM(CASE WHEN ocr_status = 'completed' THEN 1 ELSE 0 END) AS analyzed,
+            SUM(CASE WHEN ocr_status IN ('pending', 'processing') THEN 1 ELSE 0 END) AS pending,
+            SUM(CASE WHEN ocr_status = 'failed' THEN 1 ELSE 0 END) AS failed,
+            AVG(CASE WHEN ocr_confidence > 0 THEN ocr_confidence END) AS avg_ocr_conf,
+            SUM(CASE WHEN extraction_status = 'completed' THEN 1 ELSE 0 END) AS fully_analyzed,
+            AVG(CASE WHEN confidence_score > 0 THEN confidence_score END) AS avg_ext_conf,
+            AVG(entry_multiple) AS avg_mult,
+            SUM(purchase_price) AS total_val
+        FROM documents
+    ''')
     row = cursor.fetchone()
+    total = row['total']
+    analyzed = row['analyzed'] or 0
+    pending = row['pending'] or 0
+    failed = row['failed'] or 0
+    accuracy = round((row['avg_ocr_conf'] or 0) * 100, 1)
+    fully_analyzed = row['fully_analyzed'] or 0
+    avg_extraction_confidence = round((row['avg_ext_conf'] or 0) * 100, 1)
     avg_entry_multiple = round(row['avg_mult'] or 0, 1)
-
-    cursor.execute('SELECT SUM(purchase_price) as total_val FROM documents WHERE purchase_price IS NOT NULL')
-    row = cursor.fetchone()
     total_deal_value = row['total_val'] or 0
 
     cursor.execute(
@@ -74,9 +168,7 @@ def dashboard():
     )
     recent = [dict(row) for row in cursor.fetchall()]
 
-    conn.close()
-
-    return jsonify({
+    return _json_response({
         'total': total,
         'analyzed': analyzed,
         'pending': pending,
@@ -99,6 +191,7 @@ def upload():
 
     files = request.files.getlist('files')
     uploaded = []
+    queued = []
 
     conn = get_db()
     cursor = conn.cursor()
@@ -111,7 +204,8 @@ def upload():
         ext = os.path.splitext(file.filename)[1]
         unique_name = f"{uuid.uuid4().hex}{ext}"
         filepath = os.path.join(UPLOAD_FOLDER, unique_name)
-        file.save(filepath)
+        file.stream.close()
+        os.replace(file.stream.name, filepath)
 
         size = os.path.getsize(filepath)
 
@@ -120,54 +214,107 @@ def upload():
             (unique_name, file.filename, size)
         )
 
-        doc_id = cursor.lastrowid
-        conn.commit()
-
-        # Launch OCR in background thread
-        thread = threading.Thread(
-            target=process_document_ocr,
-            args=(doc_id, filepath),
-            daemon=True
-        )
-        thread.start()
-
         uploaded.append({
-            'id': doc_id,
+            'id': cursor.lastrowid,
             'original_name': file.filename,
             'size': size,
             'status': 'processing',
             'message': 'File uploaded. OCR processing started.'
         })
+        queued.append((cursor.lastrowid, filepath))
+
+    # One commit for the whole batch; workers only start once their rows are visible
+    conn.commit()
+
+    for doc_id, filepath in queued:
+        submit_ocr(doc_id, filepath)
 
-    conn.close()
+    _invalidate('dashboard')
 
     return jsonify({'uploaded': uploaded}), 201
 
 
 # ---------- Documents API ----------
 
+DOCUMENTS_PAGE_SIZE = 50
+DOCUMENTS_MAX_PAGE_SIZE = 200
+
+# Fields the documents table in the UI renders
+LIST_COLS = ('id, original_name, company_name, size, page_count, confidence_score, upload_date, '
+             'status, ocr_status, extraction_status')
+
+# Columns each single-document endpoint reads, so rows skip unused fields
+STATUS_COLS = ('id, original_name, status, ocr_status, ocr_confidence, page_count, word_count, '
+               'ocr_completed_at, error_message, extraction_status, extraction_error, company_name, confidence_score')
+TEXT_COLS = 'id, original_name, ocr_status, processed_text_path, word_count, page_count'
+EXTRACTION_COLS = 'extraction_status, extraction_error, extraction_path'
+EXTRACTION_META_COLS = 'id, original_name, extraction_status, extraction_completed_at, extraction_error, confidence_score'
+ANALYSIS_COLS = ('id, original_name, size, upload_date, ocr_status, ocr_confidence, page_count, word_count, '
+                 'extraction_status, extraction_completed_at, extraction_error, extraction_path, company_name, '
+                 'confidence_score')
+RE_EXTRACT_COLS = 'ocr_status, processed_text_path'
+ACCURACY_COLS = 'extraction_status, extraction_path'
+
+
+def _get_doc(doc_id, cols='*'):
+    """Fetch one document row (or None) on this thread's reused connection."""
+    return get_db().execute(f'SELECT {cols} FROM documents WHERE id = ?', (doc_id,)).fetchone()
+
+
+def _row_etag(row):
+    """ETag over every selected column, so any change the client could see busts it."""
+    return hashlib.md5('|'.join(map(str, row)).encode()).hexdigest()
+
+
+def _not_modified(etag):
+    """Return a 304 response if the client already holds `etag`, else None."""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
 @app.route('/api/documents')
 def get_documents():
+    # Newest first. Without paging args every row is returned (the Analysis list
+    # needs them all); pass ?limit= and the last id seen as ?before_id= to page.
+    # id is both the cursor and the sort key, so pages never skip or repeat rows.
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', type=int)
+    if before_id is not None or limit is not None:
+        limit = max(1, min(limit or DOCUMENTS_PAGE_SIZE, DOCUMENTS_MAX_PAGE_SIZE))
+
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents ORDER BY upload_date DESC')
+    if before_id is not None:
+        cursor.execute(
+            f'SELECT {LIST_COLS} FROM documents WHERE id < ? ORDER BY id DESC LIMIT ?',
+            (before_id, limit)
+        )
+    elif limit is not None:
+        cursor.execute(f'SELECT {LIST_COLS} FROM documents ORDER BY id DESC LIMIT ?', (limit,))
+    else:
+        cursor.execute(f'SELECT {LIST_COLS} FROM documents ORDER BY id DESC')
     docs = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return jsonify(docs)
+    # The list has no cheap version marker, so hash the body and let clients revalidate
+    response = jsonify(docs)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route('/api/documents/<int:doc_id>/status')
 def get_document_status(doc_id):
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = _get_doc(doc_id, STATUS_COLS)
 
     if not row:
         return jsonify({'error': 'Document not found'}), 404
 
-    return jsonify({
+    etag = _row_etag(row)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    response = jsonify({
         'document_id': row['id'],
         'filename': row['original_name'],
         'status': row['status'],
@@ -182,15 +329,13 @@ def get_document_status(doc_id):
         'company_name': row['company_name'],
         'confidence_score': row['confidence_score'],
     })
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/api/documents/<int:doc_id>/text')
 def get_document_text(doc_id):
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = _get_doc(doc_id, TEXT_COLS)
 
     if not row:
         return jsonify({'error': 'Document not found'}), 404
@@ -202,28 +347,37 @@ def get_document_text(doc_id):
         }), 202
 
     text_path = os.path.join(os.path.dirname(__file__), row['processed_text_path'])
+
+    # ?format=json keeps the original buffered JSON shape for older clients
+    if request.args.get('format') == 'json':
+        try:
+            with open(text_path, 'r', encoding='utf-8') as f:
+                text_content = f.read()
+        except FileNotFoundError:
+            return jsonify({'error': 'Processed text file not found'}), 404
+
+        return jsonify({
+            'document_id': row['id'],
+            'filename': row['original_name'],
+            'text': text_content,
+            'word_count': row['word_count'],
+            'page_count': row['page_count'],
+        })
+
+    # Otherwise stream the file (range and conditional requests included); counts ride in headers
     try:
-        with open(text_path, 'r', encoding='utf-8') as f:
-            text_content = f.read()
+        response = send_file(text_path, mimetype='text/plain', conditional=True)
     except FileNotFoundError:
         return jsonify({'error': 'Processed text file not found'}), 404
-
-    return jsonify({
-        'document_id': row['id'],
-        'filename': row['original_name'],
-        'text': text_content,
-        'word_count': row['word_count'],
-        'page_count': row['page_count'],
-    })
+    response.headers['X-Word-Count'] = str(row['word_count'])
+    response.headers['X-Page-Count'] = str(row['page_count'])
+    return response
 
 
 @app.route('/api/documents/<int:doc_id>/extraction')
 def get_document_extraction(doc_id):
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
-    row = cursor.fetchone()
-    conn.close()
+    """Serve the stored extraction JSON as-is; row metadata is at /extraction/meta."""
+    row = _get_doc(doc_id, EXTRACTION_COLS)
 
     if not row:
         return jsonify({'error': 'Document not found'}), 404
@@ -235,36 +389,55 @@ def get_document_extraction(doc_id):
             'message': 'Extraction not yet complete'
         }), 202
 
-    # Read the full extraction JSON
+    # Stream the file untouched; conditional=True answers repeat polls with 304
     extraction_path = os.path.join(os.path.dirname(__file__), row['extraction_path'])
     try:
-        with open(extraction_path, 'r', encoding='utf-8') as f:
-            extraction_data = json.load(f)
+        if not extraction_path.endswith('.gz'):
+            return send_file(extraction_path, mimetype='application/json', conditional=True)
+        if request.accept_encodings['gzip']:  # parsed q-value, so gzip;q=0 is a refusal
+            response = send_file(extraction_path, mimetype='application/json',
+                                 download_name=f'{doc_id}.json', conditional=True)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = send_file(gzip.open(extraction_path, 'rb'), mimetype='application/json',
+                                 download_name=f'{doc_id}.json')
+        response.vary.add('Accept-Encoding')
+        return response
     except FileNotFoundError:
         return jsonify({'error': 'Extraction file not found'}), 404
 
-    return jsonify({
+
+@app.route('/api/documents/<int:doc_id>/extraction/meta')
+def get_document_extraction_meta(doc_id):
+    row = _get_doc(doc_id, EXTRACTION_META_COLS)
+
+    if not row:
+        return jsonify({'error': 'Document not found'}), 404
+
+    return _json_response({
         'document_id': row['id'],
         'filename': row['original_name'],
-        'extraction_status': row['extraction_status'],
+        'extraction_status': row['extraction_status'] or 'pending',
         'extraction_completed_at': row['extraction_completed_at'],
+        'extraction_error': row['extraction_error'],
         'confidence_score': row['confidence_score'],
-        'data': extraction_data,
     })
 
 
 @app.route('/api/documents/<int:doc_id>/analysis')
 def get_document_analysis(doc_id):
     """Combined endpoint returning OCR + extraction data for analysis view."""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = _get_doc(doc_id, ANALYSIS_COLS)
 
     if not row:
         return jsonify({'error': 'Document not found'}), 404
 
+    # extraction_completed_at and extraction_path move whenever the file is rewritten
+    etag = _row_etag(row)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
     result = {
         'document_id': row['id'],
         'filename': row['original_name'],
@@ -284,8 +457,7 @@ def get_document_analysis(doc_id):
     if row['extraction_status'] == 'completed' and row['extraction_path']:
         extraction_path = os.path.join(os.path.dirname(__file__), row['extraction_path'])
         try:
-            with open(extraction_path, 'r', encoding='utf-8') as f:
-                extraction = json.load(f)
+            extraction = _load_json(extraction_path)
             result['extraction'] = extraction
             # Flatten key fields to top level for convenience
             result['company_name'] = extraction.get('company_name') or row['company_name']
@@ -296,17 +468,15 @@ def get_document_analysis(doc_id):
         except FileNotFoundError:
             pass
 
-    return jsonify(result)
+    response = _json_response(result)
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/api/documents/<int:doc_id>/re-extract', methods=['POST'])
 def re_extract_document(doc_id):
     """Re-run AI extraction on a document that already has OCR completed."""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = _get_doc(doc_id, RE_EXTRACT_COLS)
 
     if not row:
         return jsonify({'error': 'Document not found'}), 404
@@ -314,52 +484,36 @@ def re_extract_document(doc_id):
     if row['ocr_status'] != 'completed' or not row['processed_text_path']:
         return jsonify({'error': 'OCR not completed for this document'}), 400
 
-    # Launch extraction in background thread
-    thread = threading.Thread(
-        target=extract_document_financials,
-        args=(doc_id, row['processed_text_path']),
-        daemon=True
-    )
-    thread.start()
+    # Queue extraction on the background pool; skip the response cache so the model is re-asked
+    submit_extraction(doc_id, row['processed_text_path'], use_cache=False)
 
     return jsonify({'message': f'Re-extraction started for document {doc_id}'}), 202
 
 
 @app.route('/api/documents/<int:doc_id>', methods=['DELETE'])
 def delete_document(doc_id):
-    conn = get_db()
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT filename, raw_ocr_path, processed_text_path, extraction_path FROM documents WHERE id = ?', (doc_id,))
-    row = cursor.fetchone()
+    row = _get_doc(doc_id, 'filename, raw_ocr_path, processed_text_path, extraction_path')
 
     if not row:
-        conn.close()
         return jsonify({'error': 'Document not found'}), 404
 
-    # Delete uploaded file
-    filepath = os.path.join(UPLOAD_FOLDER, row['filename'])
-    if os.path.exists(filepath):
-        os.remove(filepath)
-
-    # Delete OCR files if they exist
+    # Remove the upload and any OCR/extraction artifacts; missing files or
+    # unset (NULL) paths are fine, so just attempt each unlink once
     base_dir = os.path.dirname(__file__)
-    if row['raw_ocr_path']:
-        raw_path = os.path.join(base_dir, row['raw_ocr_path'])
-        if os.path.exists(raw_path):
-            os.remove(raw_path)
-    if row['processed_text_path']:
-        proc_path = os.path.join(base_dir, row['processed_text_path'])
-        if os.path.exists(proc_path):
-            os.remove(proc_path)
-    if row['extraction_path']:
-        ext_path = os.path.join(base_dir, row['extraction_path'])
-        if os.path.exists(ext_path):
-            os.remove(ext_path)
-
-    cursor.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+    paths = [os.path.join(UPLOAD_FOLDER, row['filename'])]
+    for col in ('raw_ocr_path', 'processed_text_path', 'extraction_path'):
+        if row[col]:
+            paths.append(os.path.join(base_dir, row[col]))
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    conn = get_db()
+    conn.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
     conn.commit()
-    conn.close()
+    _invalidate('dashboard')
 
     return jsonify({'message': 'Document deleted'})
 
@@ -390,6 +544,45 @@ CHIMERA_GROUND_TRUTH = {
     'term_rate': 0.07,
 }
 
+# Where each ground-truth field lives in the extraction JSON: name -> (section, key)
+_GT_SOURCES = {
+    'net_revenue_hist': ('financials', 'net_revenue_hist'),
+    'gross_profit_hist': ('financials', 'gross_profit_hist'),
+    'sga_hist': ('financials', 'sga_hist'),
+    'adjustments_hist': ('financials', 'adjustments_hist'),
+    'adj_ebitda_hist': ('financials', 'adj_ebitda_hist'),
+    'depreciation_hist': ('financials', 'depreciation_hist'),
+    'capex_hist': ('financials', 'capex_hist'),
+    'net_revenue_proj': ('financials', 'net_revenue_proj'),
+    'adj_ebitda_proj': ('financials', 'adj_ebitda_proj'),
+    'depreciation_proj': ('financials', 'depreciation_proj'),
+    'capex_proj': ('financials', 'capex_proj'),
+    'mgmt_fees_proj': ('financials', 'mgmt_fees_proj'),
+    'entry_multiple': ('deal', 'entry_multiple'),
+    'purchase_price': ('deal', 'purchase_price_calculated'),
+    'ebitda_for_price': ('deal', 'ebitda_for_price'),
+    'revenue_ltm': ('deal', 'revenue_ltm'),
+    'ebitda_ltm': ('deal', 'ebitda_ltm'),
+    'ar_value': ('collateral', 'ar_value'),
+    'inventory_value': ('collateral', 'inventory_value'),
+    'abl_rate': ('rates', 'abl_rate'),
+    'term_rate': ('rates', 'term_rate'),
+}
+
+# Flattened once at import: (field_name, section, key, expected) in report order
+_GT_FIELDS = tuple(
+    (name, *_GT_SOURCES[name], expected)
+    for name, expected in CHIMERA_GROUND_TRUTH.items()
+)
+
+
+def _within_tolerance(extracted, expected, tolerance):
+    """Return (passed, pct_err) for one value; pct_err is None when expected is 0."""
+    if expected == 0:
+        return extracted == 0, None
+    pct_err = abs(extracted - expected) / abs(expected)
+    return pct_err <= tolerance, pct_err
+
 
 def _compare_field(extracted, expected, tolerance=0.05):
     """Compare a single field value against expected with tolerance."""
@@ -412,37 +605,28 @@ def _compare_field(extracted, expected, tolerance=0.05):
                 results.append({'index': i, 'status': 'FAIL', 'error': 'null'})
                 all_pass = False
                 continue
-            if exp_v == 0:
-                if ext_v == 0:
-                    results.append({'index': i, 'status': 'PASS'})
-                else:
-                    results.append({'index': i, 'status': 'FAIL', 'extracted': ext_v, 'expected': exp_v})
-                    all_pass = False
-                continue
-            pct_err = abs(ext_v - exp_v) / abs(exp_v)
-            if pct_err <= tolerance:
-                results.append({'index': i, 'status': 'PASS', 'error_pct': f'{pct_err:.1%}'})
-            else:
-                results.append({'index': i, 'status': 'FAIL', 'extracted': ext_v, 'expected': exp_v, 'error_pct': f'{pct_err:.1%}'})
+            passed, pct_err = _within_tolerance(ext_v, exp_v, tolerance)
+            item = {'index': i, 'status': 'PASS' if passed else 'FAIL'}
+            if not passed:
+                item['extracted'] = ext_v
+                item['expected'] = exp_v
                 all_pass = False
+            if pct_err is not None:
+                item['error_pct'] = f'{pct_err:.1%}'
+            results.append(item)
         return {'status': 'PASS' if all_pass else 'FAIL', 'extracted': extracted, 'expected': expected, 'details': results}
     else:
-        if expected == 0:
-            status = 'PASS' if extracted == 0 else 'FAIL'
-            return {'status': status, 'extracted': extracted, 'expected': expected}
-        pct_err = abs(extracted - expected) / abs(expected)
-        status = 'PASS' if pct_err <= tolerance else 'FAIL'
-        return {'status': status, 'extracted': extracted, 'expected': expected, 'error_pct': f'{pct_err:.1%}'}
+        passed, pct_err = _within_tolerance(extracted, expected, tolerance)
+        result = {'status': 'PASS' if passed else 'FAIL', 'extracted': extracted, 'expected': expected}
+        if pct_err is not None:
+            result['error_pct'] = f'{pct_err:.1%}'
+        return result
 
 
 @app.route('/api/documents/<int:doc_id>/accuracy')
 def get_document_accuracy(doc_id):
     """Compare extraction to known ground truth (Chimera hardcoded)."""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = _get_doc(doc_id, ACCURACY_COLS)
 
     if not row:
         return jsonify({'error': 'Document not found'}), 404
@@ -452,46 +636,16 @@ def get_document_accuracy(doc_id):
 
     extraction_path = os.path.join(os.path.dirname(__file__), row['extraction_path'])
     try:
-        with open(extraction_path, 'r', encoding='utf-8') as f:
-            ext = json.load(f)
+        ext = _load_json(extraction_path)
     except FileNotFoundError:
         return jsonify({'error': 'Extraction file not found'}), 404
 
-    fin = ext.get('financials', {})
-    deal = ext.get('deal', {})
-    coll = ext.get('collateral', {})
-    rates_data = ext.get('rates', {})
-
-    field_map = {
-        'net_revenue_hist': fin.get('net_revenue_hist'),
-        'gross_profit_hist': fin.get('gross_profit_hist'),
-        'sga_hist': fin.get('sga_hist'),
-        'adjustments_hist': fin.get('adjustments_hist'),
-        'adj_ebitda_hist': fin.get('adj_ebitda_hist'),
-        'depreciation_hist': fin.get('depreciation_hist'),
-        'capex_hist': fin.get('capex_hist'),
-        'net_revenue_proj': fin.get('net_revenue_proj'),
-        'adj_ebitda_proj': fin.get('adj_ebitda_proj'),
-        'depreciation_proj': fin.get('depreciation_proj'),
-        'capex_proj': fin.get('capex_proj'),
-        'mgmt_fees_proj': fin.get('mgmt_fees_proj'),
-        'entry_multiple': deal.get('entry_multiple'),
-        'purchase_price': deal.get('purchase_price_calculated'),
-        'ebitda_for_price': deal.get('ebitda_for_price'),
-        'revenue_ltm': deal.get('revenue_ltm'),
-        'ebitda_ltm': deal.get('ebitda_ltm'),
-        'ar_value': coll.get('ar_value'),
-        'inventory_value': coll.get('inventory_value'),
-        'abl_rate': rates_data.get('abl_rate'),
-        'term_rate': rates_data.get('term_rate'),
-    }
-
     field_accuracy = {}
     fields_checked = 0
     fields_correct = 0
 
-    for field_name, expected in CHIMERA_GROUND_TRUTH.items():
-        extracted = field_map.get(field_name)
+    for field_name, section, key, expected in _GT_FIELDS:
+        extracted = (ext.get(section) or {}).get(key)
         result = _compare_field(extracted, expected)
         field_accuracy[field_name] = result
         if result['status'] != 'SKIP':
@@ -501,7 +655,7 @@ def get_document_accuracy(doc_id):
 
     accuracy_score = round((fields_correct / fields_checked * 100), 1) if fields_checked > 0 else 0
 
-    return jsonify({
+    return _json_response({
         'accuracy_score': accuracy_score,
         'fields_checked': fields_checked,
         'fields_correct': fields_correct,
@@ -514,12 +668,12 @@ def get_document_accuracy(doc_id):
 # ---------- Settings API ----------
 
 @app.route('/api/settings')
+@_cached(ttl=60)
 def get_settings():
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT key, value FROM settings')
     settings = {row['key']: row['value'] for row in cursor.fetchall()}
-    conn.close()
     return jsonify(settings)
 
 
@@ -539,7 +693,7 @@ def update_settings():
         )
 
     conn.commit()
-    conn.close()
+    _invalidate('get_settings')
 
     return jsonify({'message': 'Settings updated'})
 
@@ -547,5 +701,4 @@ def update_settings():
 # ---------- Start Server ----------
 
 if __name__ == '__main__':
-    init_db()
     app.run(debug=True, port=5000)
@@ -1,19 +1,65 @@
 import sqlite3
 import os
+import queue
+import atexit
+import threading
+from datetime import datetime, timezone
+from itertools import groupby
+from operator import itemgetter
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'docanalyzer.db')
 
+# Callables run after a document update commits (e.g. response cache invalidation)
+_write_listeners = []
+
+
+# One long-lived connection per thread (request workers and background jobs)
+_local = threading.local()
+
+_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+)
+
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Return this thread's connection, opening and tuning it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
     return conn
 
 
+def release_db():
+    """Roll back any transaction left open on this thread's connection."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+# Bump whenever init_db() gains new DDL so existing databases migrate once
+SCHEMA_VERSION = 2
+
+
 def init_db():
+    _start_writer()
+
     conn = get_db()
     cursor = conn.cursor()
 
+    # Stamped into the file header after a successful migration; kept out of
+    # the settings table because /api/settings exposes every row to clients
+    cursor.execute('PRAGMA user_version')
+    if cursor.fetchone()[0] == SCHEMA_VERSION:
+        return
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS documents (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -84,42 +130,140 @@ def init_db():
                 f'ALTER TABLE documents ADD COLUMN {col_name} {col_def}'
             )
 
+    # --- Indexes for dashboard status filters and recent-first listings ---
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_docs_ocr_status ON documents(ocr_status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_docs_extraction_status ON documents(extraction_status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_docs_upload_date ON documents(upload_date DESC)')
+
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
     conn.commit()
-    conn.close()
 
+    # Refresh planner statistics so the new indexes are picked up
+    cursor.execute('ANALYZE')
 
-def update_document_ocr_status(doc_id, ocr_status_value, **kwargs):
-    """Update OCR fields for a document. Pass any column as a keyword arg."""
+
+# Background jobs hand their UPDATEs to one writer thread, which commits
+# everything queued since its last pass in a single transaction
+_write_q = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _writer_loop():
     conn = get_db()
-    cursor = conn.cursor()
+    while True:
+        items = [_write_q.get()]
+        while True:
+            try:
+                items.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
 
-    fields = {'ocr_status': ocr_status_value}
-    fields.update(kwargs)
+        try:
+            _apply_writes(conn, items)
+            _notify_write()
+        except Exception as e:
+            # Never let the only writer thread die: later updates would be lost
+            # and the atexit join would hang
+            print(f"[DB ERROR] writer: {e}")
+        finally:
+            for _ in items:
+                _write_q.task_done()
 
-    set_clause = ', '.join(f'{k} = ?' for k in fields)
-    values = list(fields.values()) + [doc_id]
 
-    cursor.execute(
-        f'UPDATE documents SET {set_clause} WHERE id = ?',
-        values
-    )
+def _apply_writes(conn, items):
+    try:
+        with conn:
+            # Runs of the same statement (sorted column lists make repeats
+            # common) go through executemany; queue order is kept
+            for sql, group in groupby(items, key=itemgetter(0)):
+                conn.executemany(sql, [item[1] for item in group])
+    except Exception:
+        # Replay one by one so a single bad statement doesn't drop the batch
+        for sql, values, fail_sql in items:
+            try:
+                with conn:
+                    conn.execute(sql, values)
+            except Exception as e:
+                print(f"[DB ERROR] {e}: {sql}")
+                _mark_failed(conn, fail_sql, values[-1], e)
 
-    conn.commit()
-    conn.close()
 
+def _mark_failed(conn, fail_sql, doc_id, error):
+    """Record a lost update as a failed status, as the caller's except would have."""
+    try:
+        with conn:
+            conn.execute(fail_sql, (f'Database update failed: {error}', doc_id))
+    except Exception as e:
+        print(f"[DB ERROR] could not mark document {doc_id} failed: {e}")
 
-def update_document_extraction(doc_id, **kwargs):
-    """Update extraction fields for a document."""
-    conn = get_db()
-    cursor = conn.cursor()
 
-    set_clause = ', '.join(f'{k} = ?' for k in kwargs)
-    values = list(kwargs.values()) + [doc_id]
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+            _writer.start()
+            # Let queued updates land before the interpreter tears down daemon threads
+            atexit.register(_write_q.join)
 
-    cursor.execute(
-        f'UPDATE documents SET {set_clause} WHERE id = ?',
-        values
-    )
 
-    conn.commit()
-    conn.close()
+def _enqueue_write(sql, values, fail_sql):
+    """Queue an UPDATE; if it fails in the writer, fail_sql (error, doc_id) runs instead."""
+    if _writer is None:
+        _start_writer()
+    _write_q.put((sql, values, fail_sql))
+
+
+def on_document_write(callback):
+    """Register a no-argument callable to run after each document update."""
+    _write_listeners.append(callback)
+
+
+def _notify_write():
+    for callback in _write_listeners:
+        try:
+            callback()
+        except Exception as e:
+            print(f"[DB ERROR] write listener {callback!r}: {e}")
+
+
+# Column tuple -> UPDATE text. Sorting the columns means every call with the
+# same set of fields produces identical SQL and hits sqlite3's statement cache.
+_UPDATE_SQL = {}
+
+
+def _update_sql(doc_id, fields):
+    cols = tuple(sorted(fields))
+    sql = _UPDATE_SQL.get(cols)
+    if sql is None:
+        set_clause = ', '.join(f'{k} = ?' for k in cols)
+        sql = _UPDATE_SQL[cols] = f'UPDATE documents SET {set_clause} WHERE id = ?'
+    return sql, [fields[k] for k in cols] + [doc_id]
+
+
+_UTC = timezone.utc
+
+
+def utc_now_iso():
+    """ISO 8601 UTC timestamp for the *_completed_at columns."""
+    # Keep microseconds: API ETags derive from these, so rewrites within one second must differ
+    return datetime.now(_UTC).isoformat()
+
+
+# Written in place of an update the writer could not apply, so the document
+# doesn't sit in 'processing' forever
+_OCR_FAILED_SQL = "UPDATE documents SET ocr_status = 'failed', status = 'failed', error_message = ? WHERE id = ?"
+_EXTRACTION_FAILED_SQL = "UPDATE documents SET extraction_status = 'failed', extraction_error = ? WHERE id = ?"
+
+
+def update_document_ocr_status(doc_id, ocr_status_value, **kwargs):
+    """Queue an update of OCR fields for a document. Pass any column as a keyword arg."""
+    fields = {'ocr_status': ocr_status_value}
+    fields.update(kwargs)
+    _enqueue_write(*_update_sql(doc_id, fields), _OCR_FAILED_SQL)
+
+
+def update_document_extraction(doc_id, **kwargs):
+    """Queue an update of extraction fields for a document."""
+    _enqueue_write(*_update_sql(doc_id, kwargs), _EXTRACTION_FAILED_SQL)
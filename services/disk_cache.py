@@ -0,0 +1,90 @@
+import os
+import tempfile
+import threading
+import contextlib
+
+
+class DiskCache:
+    """A folder of content-addressed files capped at `max_bytes` with LRU eviction.
+
+    Every operation is best effort: an I/O error is logged and treated as a miss
+    (read) or a skipped entry (write), so the cache can never fail the work it
+    sits in front of.
+    """
+
+    def __init__(self, folder, suffix, max_bytes, label):
+        self.folder = folder
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.label = label
+        # Running total of the folder's size (None until first measured), so
+        # the folder is only listed when a write pushes it over the cap
+        self._bytes = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.folder, f'{key}{self.suffix}')
+
+    def read(self, path):
+        """Return the entry's bytes, or None on a miss or unreadable file."""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            print(f"[{self.label}] ignoring {path}: {e}")
+            return None
+        # Mark as recently used for eviction; a concurrent prune may already
+        # have removed the file, which is fine since the bytes are in memory
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return data
+
+    def write(self, path, data):
+        tmp_path = None
+        try:
+            # Write beside the target and rename so concurrent readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            is_new = not os.path.exists(path)
+            os.replace(tmp_path, path)
+            tmp_path = None
+
+            with self._lock:
+                if self._bytes is None:
+                    self._bytes = self._prune()
+                else:
+                    if is_new:
+                        self._bytes += len(data)
+                    if self._bytes > self.max_bytes:
+                        self._bytes = self._prune()
+        except OSError as e:
+            print(f"[{self.label}] could not write {path}: {e}")
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+
+    def _prune(self):
+        """Evict least recently used entries once the folder exceeds max_bytes; returns its size."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(self.suffix):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total <= self.max_bytes:
+            return total
+
+        # Evict down to 90% of the cap so the next few writes don't each trigger a rescan
+        target = self.max_bytes * 9 // 10
+        entries.sort()
+        for _, size, path in entries:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+            if total <= target:
+                break
+        return total
@@ -0,0 +1,99 @@
+# JSON Schema for the model's extraction reply. Mirrors the SYS_SCHEMA prompt
+# block in extraction_service and is sent as response_format so the endpoint can
+# constrain decoding to a single object of this shape.
+
+HIST_YEARS = 3
+PROJ_YEARS = 5
+
+_NUMBER = {'type': 'number'}
+_NUMBER_OR_NULL = {'type': ['number', 'null']}
+_INTEGER = {'type': 'integer'}
+_STRING_OR_NULL = {'type': ['string', 'null']}
+_FIELD_CONFIDENCE = {'type': 'string', 'enum': ['high', 'medium', 'low', 'not_found']}
+
+
+def _object(properties):
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(properties),
+        'additionalProperties': False,
+    }
+
+
+def _series(years):
+    return {'type': 'array', 'items': _NUMBER_OR_NULL, 'minItems': years, 'maxItems': years}
+
+
+def _fields(names, schema):
+    return {name: schema for name in names}
+
+
+HIST_KEYS = (
+    'net_revenue_hist', 'gross_profit_hist', 'sga_hist', 'adjustments_hist',
+    'adj_ebitda_hist', 'other_income_hist', 'depreciation_hist', 'capex_hist',
+    'ebitda_margin_hist', 'gm_pct_hist', 'revenue_growth_hist',
+)
+PROJ_KEYS = (
+    'net_revenue_proj', 'gross_profit_proj', 'sga_proj', 'adjustments_proj',
+    'adj_ebitda_proj', 'depreciation_proj', 'capex_proj', 'mgmt_fees_proj',
+    'ebitda_margin_proj',
+)
+
+EXTRACTION_SCHEMA = _object({
+    'company_name': _STRING_OR_NULL,
+    'industry': _STRING_OR_NULL,
+    'geography': _STRING_OR_NULL,
+    'transaction_date': _STRING_OR_NULL,
+    'historical_years': {'type': 'array', 'items': _STRING_OR_NULL, 'minItems': HIST_YEARS, 'maxItems': HIST_YEARS},
+    'projection_years': {'type': 'array', 'items': _STRING_OR_NULL, 'minItems': PROJ_YEARS, 'maxItems': PROJ_YEARS},
+    'financials': _object({
+        **_fields(HIST_KEYS, _series(HIST_YEARS)),
+        **_fields(PROJ_KEYS, _series(PROJ_YEARS)),
+    }),
+    'collateral': _object({
+        'ar_value': _NUMBER_OR_NULL, 'ar_advance_rate': _NUMBER,
+        'inventory_value': _NUMBER_OR_NULL, 'inventory_advance_rate': _NUMBER,
+        'equipment_value': _NUMBER_OR_NULL, 'equipment_advance_rate': _NUMBER,
+        'building_land_value': _NUMBER_OR_NULL, 'building_advance_rate': _NUMBER,
+        'abl_availability_calculated': _NUMBER_OR_NULL,
+    }),
+    'deal': _object({
+        'ebitda_for_price': _NUMBER_OR_NULL, 'entry_multiple': _NUMBER_OR_NULL,
+        'pct_acquired': _NUMBER, 'purchase_price_calculated': _NUMBER_OR_NULL,
+        'enterprise_value': _NUMBER_OR_NULL, 'exit_multiple': _NUMBER_OR_NULL,
+        'term_loan_amount': _NUMBER, 'seller_note_amount': _NUMBER,
+        'earnout_amount': _NUMBER, 'equity_rollover': _NUMBER,
+        'leverage_ratio': _NUMBER_OR_NULL,
+    }),
+    'rates': _object({
+        'abl_rate': _NUMBER, 'term_rate': _NUMBER, 'seller_note_rate': _NUMBER,
+        'tax_rate': _NUMBER, 'term_amort_years': _INTEGER, 'seller_note_amort_years': _INTEGER,
+    }),
+    'fees': _object(_fields((
+        'abl_fee_rate', 'term_fee_rate', 'legal_fees', 'qofe_fees',
+        'tax_fees', 'rw_insurance', 'bonus_senior', 'bonus_junior',
+    ), _NUMBER)),
+    'qualitative': _object({
+        'key_highlights': {'type': 'array', 'items': {'type': 'string'}},
+        'risks': {'type': 'array', 'items': {'type': 'string'}},
+        'company_summary': _STRING_OR_NULL,
+    }),
+    'confidence': _object({
+        **_fields((
+            'deal_overview_confidence', 'financial_summary_confidence',
+            'deal_metrics_confidence', 'collateral_confidence',
+            'projections_confidence', 'overall_confidence',
+        ), _INTEGER),
+        'field_level': _object(_fields((
+            'net_revenue', 'gross_profit', 'sga', 'adj_ebitda', 'adjustments',
+            'depreciation', 'capex', 'projections', 'ar_value', 'inventory',
+            'entry_multiple', 'purchase_price', 'abl_rate', 'exit_multiple',
+        ), _FIELD_CONFIDENCE)),
+    }),
+})
+
+RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {'name': 'cim_extraction', 'schema': EXTRACTION_SCHEMA},
+}
@@ -1,26 +1,61 @@
 import os
-import json
+import re
+import sys
+import gzip
 import time
-from datetime import datetime, timezone
+import orjson
+import hashlib
+import threading
+from functools import lru_cache
 
-from openai import OpenAI
+from openai import DEFAULT_CONNECTION_LIMITS, NOT_GIVEN, DefaultHttpxClient, OpenAI, RateLimitError
 from dotenv import load_dotenv
 
-from database import update_document_extraction
+from database import update_document_extraction, utc_now_iso
+from services.disk_cache import DiskCache
+from services.extraction_schema import HIST_KEYS, HIST_YEARS, PROJ_KEYS, PROJ_YEARS, RESPONSE_FORMAT
+
+try:
+    import tiktoken
+except ImportError:  # optional: token counts fall back to a chars/4 estimate
+    tiktoken = None
 
 load_dotenv()
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 EXTRACTIONS_FOLDER = os.path.join(BASE_DIR, os.getenv('EXTRACTIONS_FOLDER', 'storage/extractions'))
-os.makedirs(EXTRACTIONS_FOLDER, exist_ok=True)
+
+# Raw model replies keyed by prompt + model + OCR text, so retries and re-uploads skip the API
+RESPONSE_CACHE_FOLDER = os.path.join(EXTRACTIONS_FOLDER, 'cache')
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_MB', '256')) * 1024 * 1024
+_response_cache = DiskCache(RESPONSE_CACHE_FOLDER, '.json', RESPONSE_CACHE_MAX_BYTES, 'EXTRACTION CACHE')
 
 NVIDIA_API_KEY = os.getenv('NVIDIA_API_KEY', '')
 NVIDIA_BASE_URL = os.getenv('NVIDIA_BASE_URL', 'https://integrate.api.nvidia.com/v1')
 NVIDIA_MODEL = os.getenv('NVIDIA_MODEL', 'openai/gpt-oss-120b')
 
-MAX_TEXT_CHARS = 100000
+# Input budget for the OCR text itself, in tokens (~100K chars of CIM text); the
+# model's context window minus the prompt and reserved output caps it as well
+MAX_OCR_TOKENS = int(os.getenv('NVIDIA_MAX_OCR_TOKENS') or 25000)
+NVIDIA_CONTEXT_TOKENS = int(os.getenv('NVIDIA_CONTEXT_TOKENS') or 131072)
+MAX_OUTPUT_TOKENS = 8192
+TRUNCATION_MARKER = "\n\n[... MIDDLE SECTION TRUNCATED FOR LENGTH ...]\n\n"
+
+# Send a prompt_cache_key so the provider can reuse the prefilled SYSTEM_PROMPT prefix
+NVIDIA_PROMPT_CACHE = os.getenv('NVIDIA_PROMPT_CACHE', 'true').lower() in ('1', 'true', 'yes')
 
-SYSTEM_PROMPT = """You are a senior financial analyst and data extraction specialist for private equity transactions. You extract data from Confidential Information Memoranda (CIMs) to populate an Atar Capital Prebid Analysis model.
+# Ask the endpoint to constrain decoding to EXTRACTION_SCHEMA (response_format json_schema)
+NVIDIA_STRUCTURED_OUTPUT = os.getenv('NVIDIA_STRUCTURED_OUTPUT', 'true').lower() in ('1', 'true', 'yes')
+
+# Upper bound on in-flight API calls across all extraction threads (OCR chaining,
+# re-extracts) so bursts stay under the provider's rate limits
+NVIDIA_MAX_CONCURRENCY = int(os.getenv('NVIDIA_MAX_CONCURRENCY') or 4)
+_api_slots = threading.BoundedSemaphore(NVIDIA_MAX_CONCURRENCY)
+NVIDIA_KEEPALIVE_SECONDS = float(os.getenv('NVIDIA_KEEPALIVE_SECONDS') or 120)
+
+# The system prompt is built from fixed modules (role, extraction rules, output
+# schema) so each rule appears exactly once; only the OCR text varies per call.
+SYS_ROLE = """You are a senior financial analyst and data extraction specialist for private equity transactions. You extract data from Confidential Information Memoranda (CIMs) to populate an Atar Capital Prebid Analysis model.
 
 CRITICAL OUTPUT RULES:
 1. Return ONLY a single valid JSON object. Zero prose, zero markdown, zero explanation before or after the JSON.
@@ -29,9 +64,9 @@ CRITICAL OUTPUT RULES:
 4. CapEx MUST be NEGATIVE (e.g. -424). If CIM shows positive, negate it.
 5. Management fees MUST be NEGATIVE (e.g. -2000).
 6. EBITDA add-backs/adjustments MUST be POSITIVE (they ADD to EBITDA).
-7. Temperature = 0: be precise and conservative. Prefer null over guessing.
+7. Temperature = 0: be precise and conservative. Prefer null over guessing."""
 
-══════════════════════════════════════
+SYS_RULES = """══════════════════════════════════════
 FUNDAMENTAL TABLE EXTRACTION RULES (read this FIRST)
 ══════════════════════════════════════
 
@@ -60,17 +95,10 @@ RULE 1 — ALWAYS EXTRACT ALL COLUMNS:
   Right:  "Revenue: $125.6M | $99.1M | $92.5M" -> return [125600, 99100, 92500]
 
 RULE 2 — EBITDA MUST BE GREATER THAN OPERATING INCOME:
-  EBITDA = Operating Income + D&A + Adjustments
-  Therefore: EBITDA >= Operating Income (ALWAYS, for positive D&A)
-
-  If your extracted values show: (Gross Profit - SG&A) > adj_ebitda
-  -> You have the rows CONFUSED — the larger value is EBITDA
-  -> EBITDA is ALWAYS the LARGER number
-
-  OPERATING INCOME vs EBITDA — CRITICAL DISTINCTION:
-  Operating Income = Revenue - COGS - SG&A - D&A (appears BELOW D&A in P&L)
-  EBITDA = Revenue - COGS - SG&A (appears ABOVE D&A line, BEFORE D&A deduction)
-  Therefore: EBITDA > Operating Income (always, when D&A > 0)
+  EBITDA = Revenue - COGS - SG&A (ABOVE the D&A line) = Operating Income + D&A + Adjustments
+  Operating Income = EBITDA - D&A (BELOW the D&A line)
+  So EBITDA is ALWAYS the LARGER number. If (Gross Profit - SG&A) > adj_ebitda,
+  you have the rows CONFUSED.
 
   ROW IDENTIFICATION:
   - "EBITDA", "Adj. EBITDA", "Adjusted EBITDA" -> this is EBITDA (the LARGER number)
@@ -155,8 +183,7 @@ P&L FIELDS — HISTORICAL (3 values, oldest→newest)
   - Look for: "Selling, General & Administrative", "SG&A Expenses",
     "Operating Expenses", "Selling & Marketing" + "G&A" (sum if separate)
   - VALIDATION: SG&A should be 15-50% of revenue
-  - If extracted SG&A / revenue < 5%, it is WRONG — you grabbed a sub-item
-  - If extracted SG&A / revenue < 5%, search for a larger row and use that
+  - If extracted SG&A / revenue < 5%, it is WRONG — you grabbed a sub-item; search for a larger row
   - If still not found: return [null,null,null], NOT a small wrong number
 
   adjustments_hist RULES — 3 POSSIBLE OUTCOMES:
@@ -187,11 +214,11 @@ P&L FIELDS — HISTORICAL (3 values, oldest→newest)
   3. EBITDA RECONCILIATION: Sometimes shown as "add-back" line to reconcile Net Income to EBITDA
   4. BALANCE SHEET NOTES: "Accumulated Depreciation" changes year-over-year
   - D&A is MUCH SMALLER than EBITDA — typically 1-8% of revenue ($1-7M for $90M company)
-  - D&A is NEVER the same value as EBITDA — they are COMPLETELY different line items
+  - D&A and EBITDA are COMPLETELY different line items — NEVER copy EBITDA values into depreciation
+    (historical or projected)
   - VALIDATION: If depreciation ~= adj_ebitda (within 15%), it is WRONG — you grabbed EBITDA
   - VALIDATION: If depreciation > 50% of EBITDA, verify carefully
   - If you CANNOT find D&A in any of the 4 locations, return [null, null, null]
-  - Do NOT guess or copy EBITDA values into depreciation
 
   ─────────────────────────────────────────────────────────────
   CAPEX EXTRACTION RULES:
@@ -246,25 +273,10 @@ P&L FIELDS — HISTORICAL (3 values, oldest→newest)
       extract each year's specific value, do not flatten to the last value.
 
   STEP 2 — EXTRACTION RULES:
-
-    ARRAY COMPLETENESS:
-    If historical_years has 3 entries → capex_hist must have 3 values.
-    If projection_years has 5 entries → capex_proj must have 5 values.
-    Do not return [null, null, -424] when the CFS shows all 3 years.
-    Read all columns of the CapEx row, not just the last one.
-
-    SIGN CONVENTION:
-    CapEx must always be returned as NEGATIVE in this schema.
-    If the source document shows: CapEx $535K → return -535
-    If the source document shows: CapEx ($535K) → return -535
-    If the source document shows: CapEx -535 → return -535
-    Never return positive CapEx values.
-
-    NULL vs ZERO:
-    Return null ONLY if CapEx is completely absent from the document
-    after searching all 4 sources above.
-    Return 0 only if the document explicitly states $0 CapEx.
-    Never return 0 as a default or fallback.
+    Read ALL columns of the CapEx row (RULE 1/RULE 4) — not [null, null, -424].
+    $535K, ($535K) and -535 all → return -535. Never return positive CapEx.
+    Return null ONLY if CapEx is absent after searching all 4 sources;
+    return 0 only if the document explicitly states $0 CapEx — never as a fallback.
 
   STEP 3 — VALIDATION BEFORE RETURNING:
     For each extracted value:
@@ -289,12 +301,10 @@ P&L FIELDS — PROJECTIONS (exactly 5 values, pad with null)
   adj_ebitda_proj, depreciation_proj, capex_proj (NEGATIVE), mgmt_fees_proj (NEGATIVE)
 
   depreciation_proj RULES:
-  - D&A is ALWAYS MUCH LESS than EBITDA in projections too
-  - For $8-20M EBITDA projections, D&A should be $1-5M range
+  - Same D&A rules as historical: for $8-20M EBITDA projections, D&A should be $1-5M range
   - D&A typically DECREASES slightly over projection years as assets age
   - VALIDATION: If depreciation_proj[i] == adj_ebitda_proj[i], it is WRONG
   - If no D&A row in projection table, use most recent historical D&A (flat)
-  - Do NOT copy EBITDA values into depreciation — they are different line items
 
   mgmt_fees_proj: Management fees, return as NEGATIVE. Default null if not found.
 
@@ -356,17 +366,17 @@ DEAL STRUCTURE
 ══════════════════════════════════════
 INTEREST RATES
 ══════════════════════════════════════
-  abl_rate RULES:
+  CRITICAL: NEVER output 0.0 for abl_rate or term_rate — use the default if not found.
+
+  abl_rate RULES (default 0.0675):
   - Revolving credit facility / ABL revolver interest rate
   - Look for "revolving credit", "ABL revolver", "revolving line" + rate
   - If SOFR-based: SOFR ~= 5.3% + spread. "SOFR + 145bps" → 0.0675
   - If Prime-based: Prime ~= 8.5% + spread
-  - CRITICAL: NEVER output 0.0 — use default 0.0675 if not found
 
-  term_rate RULES:
+  term_rate RULES (default 0.07):
   - Term loan interest rate
   - Look for "term loan", "term B", "TL" + rate
-  - CRITICAL: NEVER output 0.0 — use default 0.07 if not found
 
   seller_note_rate: Default 0.05
   tax_rate: Default 0.30
@@ -394,9 +404,9 @@ CONFIDENCE SCORING (0-100)
   0-39: Mostly missing
 
 Categories: deal_overview_confidence, financial_summary_confidence, deal_metrics_confidence, collateral_confidence, projections_confidence
-Overall = financial_summary_confidence*0.35 + deal_overview_confidence*0.20 + projections_confidence*0.20 + deal_metrics_confidence*0.15 + collateral_confidence*0.10
+Overall = financial_summary_confidence*0.35 + deal_overview_confidence*0.20 + projections_confidence*0.20 + deal_metrics_confidence*0.15 + collateral_confidence*0.10"""
 
-══════════════════════════════════════
+SYS_SCHEMA = """══════════════════════════════════════
 OUTPUT JSON SCHEMA
 ══════════════════════════════════════
 {
@@ -478,161 +488,198 @@ OUTPUT JSON SCHEMA
   }
 }"""
 
+SYSTEM_PROMPT = "\n\n".join((SYS_ROLE, SYS_RULES, SYS_SCHEMA))
 
-USER_MESSAGE_TEMPLATE = """Extract financial data from this CIM document for Atar Capital Prebid Analysis.
 
-CRITICAL INSTRUCTIONS (follow exactly):
-
-1. REVENUE AND ALL P&L ROWS: You must extract values for EVERY year column.
-   The financial table has multiple year columns (typically 3 historical + 3-5 projected).
-   Every array you return for P&L items must have exactly that many values.
-   NEVER return [value, null, null] when the table clearly has 3 data columns.
-   Go back and re-read the table if any array has fewer non-null values than year columns.
-
-2. OPERATING INCOME vs EBITDA:
-   EBITDA must always be LARGER than Operating Income.
-   EBITDA = Gross Profit - SG&A (before D&A deduction)
-   Operating Income = EBITDA - D&A (after D&A deduction)
-   If your values show (GP - SGA) > EBITDA, you have the rows confused.
-   Double-check before returning: adj_ebitda >= (gross_profit - sga) is WRONG
-   Actually: adj_ebitda should be approximately = (gross_profit - sga + adjustments)
-
-3. DEPRECIATION FROM CASH FLOW STATEMENT:
-   Find the Cash Flow Statement section.
-   The first line under "Operating Activities" after Net Income is usually D&A.
-   Extract D&A values for ALL historical years shown in that statement.
-   D&A must NEVER equal EBITDA — they are completely different line items.
-
-4. BEFORE RETURNING: Count your arrays.
-   If historical_years has 3 entries, ALL historical arrays must have 3 non-null values
-   (unless that specific cell is genuinely blank in the source document).
-   If any P&L array has fewer non-null values than the number of year columns,
-   go back and re-read the table more carefully.
-
-5. All monetary values in $000s (thousands).
-6. LTM values = index [2] (MOST RECENT year, last element).
-7. Always pad projection arrays to exactly 5 values with null.
-8. Return null for not found, 0 for explicitly zero — these are DIFFERENT.
+USER_MESSAGE_TEMPLATE = """Extract financial data from this CIM document for Atar Capital Prebid Analysis.
 
 DOCUMENT TEXT:
 {ocr_text}
 
 Return only the JSON object as specified."""
 
+# Shared by every request; the SDK only reads it
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Document text is spliced between these rather than run through str.format
+_USER_PREFIX, _USER_SUFFIX = USER_MESSAGE_TEMPLATE.split("{ocr_text}")
+
+# SYSTEM_PROMPT is static and must stay byte-identical across calls (per-document
+# content goes in the user turn), so its hash names a stable cacheable prefix
+_PROMPT_CACHE_KEY = hashlib.sha256(SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:32]
+
+# Anything that changes the model's answer for the same text must change this
+_RESPONSE_CACHE_SALT = f'{NVIDIA_MODEL}\0{SYSTEM_PROMPT}\0{USER_MESSAGE_TEMPLATE}'.encode('utf-8')
+
+
+# field_sources tags and per-year keys. The keys stay "<array>_<index>" strings
+# (static/app.js looks them up that way) but are built once here rather than
+# formatted afresh on every assignment.
+SRC_DIRECT = "direct"
+SRC_DERIVED = "derived"
+SRC_INFERRED = "inferred"
+SRC_NOT_FOUND = "not_found"
+
+# Interned, so lookups against keys already in a sources dict hit the identity
+# fast path; the tag literals above are interned by the compiler already.
+_SRC_KEYS = {
+    **{key: tuple(sys.intern(f"{key}_{i}") for i in range(HIST_YEARS)) for key in HIST_KEYS},
+    **{key: tuple(sys.intern(f"{key}_{i}") for i in range(PROJ_YEARS)) for key in PROJ_KEYS},
+}
+
+
+# Read-only stand-ins for a missing hist/proj array; code that fills gaps in
+# place gets the stored list from _ensure_list instead
+_N3 = (None,) * HIST_YEARS
+_N5 = (None,) * PROJ_YEARS
 
-def check_and_fix_row_swaps(data):
+
+def _ensure_list(d, key, years):
+    """The list stored at d[key], first storing an all-null one if it is missing or not a list.
+
+    Edits to the returned list land in `d` directly, with no write-back needed.
     """
-    Detects and fixes the Operating Income / EBITDA swap bug.
-    EBITDA must always be >= Operating Income (= GP - SGA).
-    If OpInc > EBITDA, the AI likely read EBITDA as Operating Income
-    and the real Operating Income (after D&A) as EBITDA. We swap them.
+    v = d.get(key)
+    if not isinstance(v, list):
+        v = d[key] = [None] * years
+    return v
+
 
-    IMPORTANT: Only uses SGA for swap logic if SGA passes a sanity check
-    (5-60% of revenue). Otherwise the swap would corrupt EBITDA.
+def _fix_ebitda_swaps(gp, sga, ebitda, rev, years):
+    """Replace EBITDA with GP - SGA wherever the latter is larger; edits `ebitda` in place.
+
+    Years whose SGA is outside 5-60% of revenue are skipped, since an unreliable
+    SGA would corrupt EBITDA. Returns (index, op_inc, old_ebitda) per fix.
     """
-    f = data.get("financials", {})
-    gp_h = f.get("gross_profit_hist", [None] * 3)
-    sga_h = f.get("sga_hist", [None] * 3)
-    ebd_h = f.get("adj_ebitda_hist", [None] * 3)
-    rev_h = f.get("net_revenue_hist", [None] * 3)
+    fixed = []
+    for i in range(min(years, len(gp))):
+        if gp[i] is None or sga[i] is None or ebitda[i] is None:
+            continue
+        # SGA sanity gate: must be 5-60% of revenue to be trustworthy
+        if rev[i] is not None and rev[i] > 0:
+            sga_ratio = sga[i] / rev[i]
+            if sga_ratio < 0.05 or sga_ratio > 0.60:
+                continue
 
-    swaps = []
+        op_inc = gp[i] - sga[i]
+        if op_inc > ebitda[i] and op_inc > 0:
+            fixed.append((i, op_inc, ebitda[i]))
+            ebitda[i] = round(op_inc, 2)
+    return fixed
 
-    # Check historical years: if (GP - SGA) > EBITDA, the rows are confused
-    for i in range(min(3, len(gp_h))):
-        if gp_h[i] is not None and sga_h[i] is not None and ebd_h[i] is not None:
-            # SGA sanity gate: must be 5-60% of revenue to be trustworthy
-            if rev_h[i] is not None and rev_h[i] > 0:
-                sga_ratio = sga_h[i] / rev_h[i]
-                if sga_ratio < 0.05 or sga_ratio > 0.60:
-                    continue  # SGA is unreliable, skip swap check
-
-            op_inc = gp_h[i] - sga_h[i]
-            if op_inc > ebd_h[i] and op_inc > 0:
-                # The value labeled "EBITDA" is actually Operating Income (after D&A)
-                # The real EBITDA = GP - SGA = op_inc (before D&A)
-                old_ebitda = ebd_h[i]
-                ebd_h[i] = round(op_inc, 2)
-                swaps.append(
-                    f"SWAPPED hist[{i}]: GP({gp_h[i]})-SGA({sga_h[i]})={op_inc} > "
-                    f"reported EBITDA({old_ebitda}) -- impossible. "
-                    f"Setting adj_ebitda={op_inc} (the larger value)"
-                )
 
-    # Check projection years: if GP and SGA exist in projections
-    gp_p = f.get("gross_profit_proj", [None] * 5)
-    sga_p = f.get("sga_proj", [None] * 5)
-    ebd_p = f.get("adj_ebitda_proj", [None] * 5)
-    rev_p = f.get("net_revenue_proj", [None] * 5)
-    for i in range(min(5, len(gp_p))):
-        if gp_p[i] is not None and sga_p[i] is not None and ebd_p[i] is not None:
-            # SGA sanity gate for projections
-            if rev_p[i] is not None and rev_p[i] > 0:
-                sga_ratio_p = sga_p[i] / rev_p[i]
-                if sga_ratio_p < 0.05 or sga_ratio_p > 0.60:
-                    continue
-
-            op_inc_p = gp_p[i] - sga_p[i]
-            if op_inc_p > ebd_p[i] and op_inc_p > 0:
-                old_ebitda_p = ebd_p[i]
-                ebd_p[i] = round(op_inc_p, 2)
-                swaps.append(
-                    f"SWAPPED proj[{i}]: OpInc({op_inc_p}) > EBITDA({old_ebitda_p}) -- swapped"
-                )
+def normalize_shape(data):
+    """
+    Coerce the reply into the shape the repair steps index into: each section
+    a dict, each hist array 3 long and each proj array 5 long. Short or
+    missing arrays are padded with null; values are never dropped, so a
+    longer array is left for the later steps to handle.
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"Model reply is a JSON {type(data).__name__}, not an object")
 
-    f["adj_ebitda_hist"] = ebd_h
-    f["adj_ebitda_proj"] = ebd_p
-    data["financials"] = f
+    for section in ("financials", "collateral", "deal", "rates", "fees", "qualitative", "confidence"):
+        if section in data and not isinstance(data[section], dict):
+            data[section] = {}
 
-    if swaps:
-        print(f"[INTEGRITY FIX] Row swap corrections:")
-        for s in swaps:
-            print(f"  -> {s}")
-        data.setdefault("_corrections_applied", []).extend(swaps)
+    f = data.setdefault("financials", {})
+    _pad(f, HIST_KEYS, HIST_YEARS)
+    _pad(f, PROJ_KEYS, PROJ_YEARS)
 
     return data
 
 
-def check_revenue_completeness(data):
+def _pad(f, keys, years):
+    """Null-pad each f[key] to `years` in place (a non-list becomes all null); returns the keys changed."""
+    padded = []
+    for key in keys:
+        arr = f.get(key)
+        if not isinstance(arr, list):
+            f[key] = [None] * years
+            padded.append(key)
+        else:
+            n = len(arr)
+            if n < years:
+                arr.extend([None] * (years - n))
+                padded.append(key)
+    return padded
+
+
+def check_integrity(data):
     """
-    Detects partial revenue extraction (only first year found).
-    Attempts to infer missing years from gross profit + known GM%.
+    Integrity pass over the raw model output, run before any derived fields.
+
+    1. Operating Income / EBITDA swap: EBITDA must always be >= Operating
+       Income (= GP - SGA). If OpInc > EBITDA, the AI likely read EBITDA as
+       Operating Income and the real Operating Income (after D&A) as EBITDA,
+       so EBITDA is replaced with GP - SGA. Only years whose SGA passes the
+       5-60% of revenue sanity check are considered.
+    2. Partial revenue (only some historical years found): missing years are
+       inferred from gross profit and the average GM% of the known years.
     """
     f = data.get("financials", {})
-    rev_h = f.get("net_revenue_hist", [None] * 3)
-    gp_h = f.get("gross_profit_hist", [None] * 3)
     sources = data.get("field_sources", {})
+    rev_h = _ensure_list(f, "net_revenue_hist", HIST_YEARS)
+    gp_h = f.get("gross_profit_hist", _N3)
+    sga_h = f.get("sga_hist", _N3)
+    ebd_h = _ensure_list(f, "adj_ebitda_hist", HIST_YEARS)
+    rev_p = f.get("net_revenue_proj", _N5)
+    gp_p = f.get("gross_profit_proj", _N5)
+    sga_p = f.get("sga_proj", _N5)
+    ebd_p = _ensure_list(f, "adj_ebitda_proj", PROJ_YEARS)
+
+    swaps = []
+
+    # Historical years: if (GP - SGA) > EBITDA, the rows are confused.
+    # The value labeled "EBITDA" is actually Operating Income (after D&A);
+    # the real EBITDA = GP - SGA = op_inc (before D&A)
+    for i, op_inc, old_ebitda in _fix_ebitda_swaps(gp_h, sga_h, ebd_h, rev_h, 3):
+        swaps.append(
+            f"SWAPPED hist[{i}]: GP({gp_h[i]})-SGA({sga_h[i]})={op_inc} > "
+            f"reported EBITDA({old_ebitda}) -- impossible. "
+            f"Setting adj_ebitda={op_inc} (the larger value)"
+        )
+    for i, op_inc_p, old_ebitda_p in _fix_ebitda_swaps(gp_p, sga_p, ebd_p, rev_p, 5):
+        swaps.append(
+            f"SWAPPED proj[{i}]: OpInc({op_inc_p}) > EBITDA({old_ebitda_p}) -- swapped"
+        )
 
     fixes = []
 
-    # Count non-null revenue values
-    non_null_rev = [r for r in rev_h if r is not None]
-    non_null_gp = [g for g in gp_h if g is not None]
+    # Revenue completeness: needs at least one revenue year and two GP years
+    non_null_rev = sum(r is not None for r in rev_h)
+    non_null_gp = sum(g is not None for g in gp_h)
 
-    if 0 < len(non_null_rev) < 3 and len(non_null_gp) >= 2:
-        # Calculate average GM% from years we have both rev and gp
-        known_margins = []
-        for i in range(3):
-            if i < len(rev_h) and i < len(gp_h) and rev_h[i] and gp_h[i]:
-                known_margins.append(gp_h[i] / rev_h[i])
+    if 0 < non_null_rev < 3 and non_null_gp >= 2:
+        # Average GM% from years we have both rev and gp
+        known_margins = [
+            gp_h[i] / rev_h[i]
+            for i in range(min(3, len(rev_h), len(gp_h)))
+            if rev_h[i] and gp_h[i]
+        ]
 
         if known_margins:
             avg_margin = sum(known_margins) / len(known_margins)
 
-            for i in range(3):
-                if i < len(rev_h) and rev_h[i] is None and i < len(gp_h) and gp_h[i] is not None:
+            for i in range(min(3, len(rev_h), len(gp_h))):
+                if rev_h[i] is None and gp_h[i] is not None:
                     inferred = round(gp_h[i] / avg_margin, 0)
                     rev_h[i] = inferred
                     fixes.append(
                         f"net_revenue_hist[{i}] inferred: "
                         f"GP({gp_h[i]}) / avg_gm_pct({avg_margin:.3f}) = {inferred}"
                     )
-                    sources[f"net_revenue_hist_{i}"] = "inferred"
+                    sources[_SRC_KEYS["net_revenue_hist"][i]] = SRC_INFERRED
 
-    f["net_revenue_hist"] = rev_h
     data["financials"] = f
     data["field_sources"] = sources
 
+    if swaps:
+        print(f"[INTEGRITY FIX] Row swap corrections:")
+        for s in swaps:
+            print(f"  -> {s}")
+        data.setdefault("_corrections_applied", []).extend(swaps)
+
     if fixes:
         print(f"[REVENUE INFERENCE] Applied:")
         for fix in fixes:
@@ -642,9 +689,13 @@ def check_revenue_completeness(data):
     return data
 
 
+# Projection year labels such as "25F" / "2026E"
+_YR2 = re.compile(r'(\d{2})([FE])')
+_YR4 = re.compile(r'(\d{4})([FE])')
+
+
 def derive_missing_values(data):
     """Mathematically derive missing fields from available data. Tracks field_sources."""
-    import re as _re
     f = data.get("financials", {})
     d = data.get("deal", {})
     sources = data.get("field_sources", {})
@@ -655,21 +706,21 @@ def derive_missing_values(data):
     real_proj_years = [y for y in proj_years if y is not None]
     if 1 <= len(real_proj_years) < 5:
         last_year_str = real_proj_years[-1]
-        match = _re.search(r'(\d{2})(F|E)', str(last_year_str))
+        match = _YR2.search(str(last_year_str))
         if match:
             last_yr_num = int(match.group(1))
             suffix = match.group(2)
-            prefix = last_year_str[:last_year_str.index(match.group(0))]
+            prefix = last_year_str[:match.start()]
             while len(real_proj_years) < 5:
                 last_yr_num += 1
                 real_proj_years.append(f"{prefix}{last_yr_num}{suffix}")
         else:
             # Try 4-digit year pattern like "2026E"
-            match4 = _re.search(r'(\d{4})(F|E)', str(last_year_str))
+            match4 = _YR4.search(str(last_year_str))
             if match4:
                 last_yr_num4 = int(match4.group(1))
                 suffix4 = match4.group(2)
-                prefix4 = last_year_str[:last_year_str.index(match4.group(0))]
+                prefix4 = last_year_str[:match4.start()]
                 while len(real_proj_years) < 5:
                     last_yr_num4 += 1
                     real_proj_years.append(f"{prefix4}{last_yr_num4}{suffix4}")
@@ -689,48 +740,44 @@ def derive_missing_values(data):
     for key in proj_array_keys:
         arr = f.get(key, [])
         # Ensure minimum length 5
-        while len(arr) < 5:
-            arr.append(None)
-        # Find last non-null value index
-        last_val = None
-        last_idx = -1
-        for i in range(min(5, len(arr))):
-            if arr[i] is not None:
-                last_val = arr[i]
-                last_idx = i
-        # Fill trailing nulls (positions after last real value) with flat extrapolation
-        if last_val is not None and last_idx < 4:
-            for i in range(last_idx + 1, 5):
-                if arr[i] is None:
-                    arr[i] = last_val
+        if len(arr) < 5:
+            arr.extend([None] * (5 - len(arr)))
+        # Scan back to the last real value and flat-extrapolate it over the
+        # trailing nulls after it (interior gaps are left alone)
+        for last_idx in range(4, -1, -1):
+            if arr[last_idx] is not None:
+                arr[last_idx + 1:5] = [arr[last_idx]] * (4 - last_idx)
+                break
         f[key] = arr[:5]
 
     # --- DEFAULT MGMT FEES TO $0 ---
     # Management fees are set post-acquisition by the PE sponsor; CIMs never include them.
     # Default to 0 (not null) so the Excel model has a numeric value.
-    mgmt = f.get("mgmt_fees_proj", [None] * 5)
-    if all(v is None for v in mgmt):
+    mgmt = f.get("mgmt_fees_proj", _N5)
+    if mgmt.count(None) == len(mgmt):
         f["mgmt_fees_proj"] = [0, 0, 0, 0, 0]
 
-    rev_h = f.get("net_revenue_hist", [None] * 3)
-    gp_h = f.get("gross_profit_hist", [None] * 3)
-    sga_h = f.get("sga_hist", [None] * 3)
-    adj_h = f.get("adjustments_hist", [None] * 3)
-    ebitda_h = f.get("adj_ebitda_hist", [None] * 3)
-    dep_h = f.get("depreciation_hist", [None] * 3)
-    capex_h = f.get("capex_hist", [None] * 3)
+    rev_h = f.get("net_revenue_hist", _N3)
+    gp_h = f.get("gross_profit_hist", _N3)
+    sga_h = _ensure_list(f, "sga_hist", HIST_YEARS)
+    adj_h = _ensure_list(f, "adjustments_hist", HIST_YEARS)
+    ebitda_h = f.get("adj_ebitda_hist", _N3)
+    dep_h = _ensure_list(f, "depreciation_hist", HIST_YEARS)
 
-    rev_p = f.get("net_revenue_proj", [None] * 5)
-    ebitda_p = f.get("adj_ebitda_proj", [None] * 5)
-    dep_p = f.get("depreciation_proj", [None] * 5)
-    capex_p = f.get("capex_proj", [None] * 5)
+    rev_p = f.get("net_revenue_proj", _N5)
+    ebitda_p = f.get("adj_ebitda_proj", _N5)
+    dep_p = _ensure_list(f, "depreciation_proj", PROJ_YEARS)
 
     derivations = []
 
-    # --- DERIVE SGA when null but D&A is known ---
-    # Formula: Adj EBITDA = (GP - SGA) + D&A + Adjustments
-    # So: SGA = GP + D&A + Adjustments - Adj EBITDA
-    for i in range(min(3, len(sga_h))):
+    # Hist derivations for one year depend only on that year's values, so all
+    # four run in a single pass; messages are kept per rule so the log reads
+    # rule by rule as before.
+    sga_log, adj_log, dep_log = [], [], []
+    for i in range(HIST_YEARS):
+        # --- DERIVE SGA when null but D&A is known ---
+        # Formula: Adj EBITDA = (GP - SGA) + D&A + Adjustments
+        # So: SGA = GP + D&A + Adjustments - Adj EBITDA
         if (sga_h[i] is None
                 and gp_h[i] is not None
                 and ebitda_h[i] is not None
@@ -739,44 +786,37 @@ def derive_missing_values(data):
             derived_sga = round(gp_h[i] + dep_h[i] + adj_h[i] - ebitda_h[i], 2)
             if rev_h[i] and rev_h[i] > 0 and 0.05 <= derived_sga / rev_h[i] <= 0.60:
                 sga_h[i] = derived_sga
-                derivations.append(
+                sga_log.append(
                     f"sga_hist[{i}] derived: GP({gp_h[i]}) + D&A({dep_h[i]}) + Adj({adj_h[i]}) - EBITDA({ebitda_h[i]}) = {derived_sga}")
-                sources[f"sga_hist_{i}"] = "derived"
-    f["sga_hist"] = sga_h
-
-    # --- DERIVE OPERATING INCOME (GP - SG&A) ---
-    op_income_h = []
-    for i in range(min(3, len(gp_h))):
-        if gp_h[i] is not None and sga_h[i] is not None:
-            op_income_h.append(round(gp_h[i] - sga_h[i], 2))
-        else:
-            op_income_h.append(None)
+                sources[_SRC_KEYS["sga_hist"][i]] = SRC_DERIVED
 
-    # --- DERIVE ADJUSTMENTS from EBITDA gap ---
-    # adjustments = Adj. EBITDA - Operating Income
-    for i in range(min(3, len(adj_h))):
-        if adj_h[i] is None and ebitda_h[i] is not None and op_income_h[i] is not None:
-            derived_adj = round(ebitda_h[i] - op_income_h[i], 2)
+        # --- DERIVE OPERATING INCOME (GP - SG&A) ---
+        if gp_h[i] is None or sga_h[i] is None:
+            continue
+        op_income = round(gp_h[i] - sga_h[i], 2)
+
+        # --- DERIVE ADJUSTMENTS from EBITDA gap ---
+        # adjustments = Adj. EBITDA - Operating Income
+        if adj_h[i] is None and ebitda_h[i] is not None:
+            derived_adj = round(ebitda_h[i] - op_income, 2)
             if derived_adj >= 0:  # add-backs should be non-negative
                 adj_h[i] = derived_adj
-                derivations.append(f"adjustments_hist[{i}] derived: EBITDA({ebitda_h[i]}) - OpInc({op_income_h[i]}) = {derived_adj}")
-                sources[f"adjustments_hist_{i}"] = "derived"
-    f["adjustments_hist"] = adj_h
-
-    # --- DERIVE DEPRECIATION from EBITDA - Operating Income (if adjustments are 0 or small) ---
-    # D&A = EBITDA - Operating Income - Adjustments  (when EBITDA = OpInc + D&A + Adjustments)
-    # Actually: Adj EBITDA = Operating Income + D&A + Adjustments
-    # So: D&A = Adj EBITDA - Operating Income - Adjustments
-    for i in range(min(3, len(dep_h))):
-        if dep_h[i] is None and ebitda_h[i] is not None and op_income_h[i] is not None:
+                adj_log.append(f"adjustments_hist[{i}] derived: EBITDA({ebitda_h[i]}) - OpInc({op_income}) = {derived_adj}")
+                sources[_SRC_KEYS["adjustments_hist"][i]] = SRC_DERIVED
+
+        # --- DERIVE DEPRECIATION from EBITDA - Operating Income (if adjustments are 0 or small) ---
+        # Adj EBITDA = Operating Income + D&A + Adjustments
+        # So: D&A = Adj EBITDA - Operating Income - Adjustments
+        if dep_h[i] is None and ebitda_h[i] is not None:
             adj_val = adj_h[i] if adj_h[i] is not None else 0
-            derived_dep = round(ebitda_h[i] - op_income_h[i] - adj_val, 2)
+            derived_dep = round(ebitda_h[i] - op_income - adj_val, 2)
             # D&A should be positive and reasonable (1-15% of revenue)
             if derived_dep > 0 and rev_h[i] and derived_dep / rev_h[i] < 0.15:
                 dep_h[i] = derived_dep
-                derivations.append(f"depreciation_hist[{i}] derived: EBITDA({ebitda_h[i]}) - OpInc({op_income_h[i]}) - Adj({adj_val}) = {derived_dep}")
-                sources[f"depreciation_hist_{i}"] = "derived"
-    f["depreciation_hist"] = dep_h
+                dep_log.append(f"depreciation_hist[{i}] derived: EBITDA({ebitda_h[i]}) - OpInc({op_income}) - Adj({adj_val}) = {derived_dep}")
+                sources[_SRC_KEYS["depreciation_hist"][i]] = SRC_DERIVED
+
+    derivations += sga_log + adj_log + dep_log
 
     # --- DERIVE PROJECTION D&A from historical average ---
     hist_dep_vals = [x for x in dep_h if x is not None and x > 0]
@@ -786,8 +826,7 @@ def derive_missing_values(data):
             if dep_p[i] is None and ebitda_p[i] is not None:
                 dep_p[i] = avg_dep
                 derivations.append(f"depreciation_proj[{i}] set to historical avg D&A = {avg_dep}")
-                sources[f"depreciation_proj_{i}"] = "derived"
-        f["depreciation_proj"] = dep_p
+                sources[_SRC_KEYS["depreciation_proj"][i]] = SRC_DERIVED
 
     # ══════════════════════════════════════════
     # CAPEX DERIVATION — 4-METHOD FALLBACK CHAIN
@@ -883,8 +922,8 @@ def derive_missing_values(data):
         return result, "industry_default", "very_low"
 
     # ── Apply to historical CapEx ──────────────────────────────────
-    cap_h = f.get("capex_hist", [None] * 3)
-    has_null_hist = any(v is None for v in cap_h)
+    cap_h = f.get("capex_hist", _N3)
+    has_null_hist = None in cap_h
     method_h = "direct"
     if has_null_hist:
         cap_h_derived, method_h, conf_h = derive_capex(
@@ -898,16 +937,16 @@ def derive_missing_values(data):
         derivations.append(
             f"capex_hist derived via [{method_h}]: {cap_h_derived}"
         )
-        for i, orig in enumerate(cap_h):
-            key = f"capex_hist_{i}"
-            if orig is None and cap_h_derived[i] is not None:
-                sources[key] = f"derived:{method_h}"
+        derived_tag = f"{SRC_DERIVED}:{method_h}"
+        for key, orig, filled in zip(_SRC_KEYS["capex_hist"], cap_h, cap_h_derived):
+            if orig is None and filled is not None:
+                sources[key] = derived_tag
             elif orig is not None:
-                sources[key] = "direct"
+                sources[key] = SRC_DIRECT
 
     # ── Apply to projection CapEx ──────────────────────────────────
-    cap_p = f.get("capex_proj", [None] * 5)
-    has_null_proj = any(v is None for v in cap_p)
+    cap_p = f.get("capex_proj", _N5)
+    has_null_proj = None in cap_p
     method_p = "direct"
     if has_null_proj:
         cap_p_derived, method_p, conf_p = derive_capex(
@@ -921,12 +960,12 @@ def derive_missing_values(data):
         derivations.append(
             f"capex_proj derived via [{method_p}]: {cap_p_derived}"
         )
-        for i, orig in enumerate(cap_p):
-            key = f"capex_proj_{i}"
-            if orig is None and cap_p_derived[i] is not None:
-                sources[key] = f"derived:{method_p}"
+        derived_tag = f"{SRC_DERIVED}:{method_p}"
+        for key, orig, filled in zip(_SRC_KEYS["capex_proj"], cap_p, cap_p_derived):
+            if orig is None and filled is not None:
+                sources[key] = derived_tag
             elif orig is not None:
-                sources[key] = "direct"
+                sources[key] = SRC_DIRECT
 
     # ── Final sign validation ──────────────────────────────────────
     # Ensure ALL CapEx values are negative after derivation
@@ -945,8 +984,8 @@ def derive_missing_values(data):
     # ── DERIVE SGA PROJECTIONS from historical SGA/Revenue ratio ──
     # When AI returns all-null sga_proj but we have historical SGA and projection revenue,
     # apply the average historical SGA-to-Revenue ratio to each projection year.
-    sga_p = f.get("sga_proj", [None] * 5)
-    if all(v is None for v in sga_p):
+    sga_p = _ensure_list(f, "sga_proj", PROJ_YEARS)
+    if sga_p.count(None) == len(sga_p):
         # Calculate historical SGA/Revenue ratios from known years
         hist_sga_ratios = []
         for i in range(min(3, len(sga_h))):
@@ -962,10 +1001,9 @@ def derive_missing_values(data):
                 if rev_p[i] is not None and rev_p[i] > 0:
                     derived_sga = round(avg_sga_ratio * rev_p[i], 0)
                     sga_p[i] = derived_sga
-                    sources[f"sga_proj_{i}"] = "derived:hist_ratio"
+                    sources[_SRC_KEYS["sga_proj"][i]] = "derived:hist_ratio"
                     derived_count += 1
             if derived_count > 0:
-                f["sga_proj"] = sga_p
                 derivations.append(
                     f"sga_proj derived via [hist_ratio] avg={avg_sga_ratio:.4f}: {sga_p}")
                 print(f"[SGA_PROJ] Derived {derived_count} values using hist ratio {avg_sga_ratio:.4f}")
@@ -985,40 +1023,24 @@ def derive_missing_values(data):
             if 2.0 <= derived_mult <= 15.0:
                 d["entry_multiple"] = derived_mult
                 derivations.append(f"entry_multiple derived: EV({price}) / EBITDA({ebitda_fp}) = {derived_mult}x")
-                sources["entry_multiple"] = "derived"
-
-    # --- DERIVE PURCHASE PRICE from EBITDA * Multiple ---
-    if d.get("purchase_price_calculated") is None:
-        ebitda_fp = d.get("ebitda_for_price")
-        mult = d.get("entry_multiple")
-        if ebitda_fp and mult:
-            pct = d.get("pct_acquired", 1.0) or 1.0
-            d["purchase_price_calculated"] = round(ebitda_fp * mult * pct, 0)
-            if d.get("enterprise_value") is None:
-                d["enterprise_value"] = d["purchase_price_calculated"]
-            derivations.append(f"purchase_price derived: {ebitda_fp} x {mult} x {pct} = {d['purchase_price_calculated']}")
-            sources["purchase_price"] = "derived"
+                sources["entry_multiple"] = SRC_DERIVED
 
     # --- MARK DIRECT SOURCES for fields that came from extraction ---
     for key in ["net_revenue_hist", "gross_profit_hist", "sga_hist", "adj_ebitda_hist"]:
-        arr = f.get(key, [])
-        for i, val in enumerate(arr):
-            src_key = f"{key}_{i}"
-            if src_key not in sources and val is not None:
-                sources[src_key] = "direct"
+        for src_key, val in zip(_SRC_KEYS[key], f.get(key, _N3)):
+            if val is not None and src_key not in sources:
+                sources[src_key] = SRC_DIRECT
 
     for key in ["ar_value", "inventory_value"]:
         coll = data.get("collateral", {})
         if coll.get(key) is not None and key not in sources:
-            sources[key] = "direct"
+            sources[key] = SRC_DIRECT
 
     # Mark not_found for remaining null fields
     for key in ["depreciation_hist", "capex_hist", "adjustments_hist"]:
-        arr = f.get(key, [])
-        for i, val in enumerate(arr):
-            src_key = f"{key}_{i}"
+        for src_key, val in zip(_SRC_KEYS[key], f.get(key, _N3)):
             if src_key not in sources:
-                sources[src_key] = "not_found" if val is None else "direct"
+                sources[src_key] = SRC_NOT_FOUND if val is None else SRC_DIRECT
 
     data["financials"] = f
     data["deal"] = d
@@ -1033,6 +1055,20 @@ def derive_missing_values(data):
     return data
 
 
+def _null_low_sga(sga, rev, years, name, rev_label):
+    """Null out SG&A under 5% of revenue (almost always a mis-read row); returns the corrections."""
+    corrections = []
+    for i in range(min(years, len(sga))):
+        s, r = sga[i], rev[i]
+        if r and s:
+            ratio = s / r
+            if ratio < 0.05:
+                corrections.append(
+                    f"{name}[{i}] = {s} is only {ratio:.1%} of {rev_label} — likely wrong row, setting null")
+                sga[i] = None
+    return corrections
+
+
 def validate_and_correct(data):
     """Detects and auto-corrects known extraction bugs. Logs all corrections."""
     corrections = []
@@ -1041,14 +1077,14 @@ def validate_and_correct(data):
     c = data.get("collateral", {})
     rates = data.get("rates", {})
 
-    rev_h = f.get("net_revenue_hist", [None] * 3)
-    sga_h = f.get("sga_hist", [None] * 3)
-    adj_h = f.get("adj_ebitda_hist", [None] * 3)
-    adj_b = f.get("adjustments_hist", [None] * 3)
-    gp_h = f.get("gross_profit_hist", [None] * 3)
-    dep_h = f.get("depreciation_hist", [None] * 3)
-    dep_p = f.get("depreciation_proj", [None] * 5)
-    ebt_p = f.get("adj_ebitda_proj", [None] * 5)
+    rev_h = f.get("net_revenue_hist", _N3)
+    sga_h = _ensure_list(f, "sga_hist", HIST_YEARS)
+    adj_h = _ensure_list(f, "adj_ebitda_hist", HIST_YEARS)
+    adj_b = _ensure_list(f, "adjustments_hist", HIST_YEARS)
+    gp_h = f.get("gross_profit_hist", _N3)
+    dep_h = _ensure_list(f, "depreciation_hist", HIST_YEARS)
+    dep_p = _ensure_list(f, "depreciation_proj", PROJ_YEARS)
+    ebt_p = f.get("adj_ebitda_proj", _N5)
 
     # CHECK 0: EBITDA consistency — adj_ebitda_hist[2] must match ebitda_for_price
     # ebitda_for_price is extracted independently in the deal section and is less prone to corruption
@@ -1063,21 +1099,12 @@ def validate_and_correct(data):
             adj_h[2] = ebitda_fp
             # Recalculate margin for corrected year
             if rev_h[2]:
-                margins = f.get("ebitda_margin_hist", [None] * 3)
+                margins = _ensure_list(f, "ebitda_margin_hist", HIST_YEARS)
                 if len(margins) > 2:
                     margins[2] = round(ebitda_fp / rev_h[2], 4)
-                    f["ebitda_margin_hist"] = margins
-    f["adj_ebitda_hist"] = adj_h
 
     # CHECK 1: SG&A sanity — must be 15-50% of revenue
-    for i in range(min(3, len(sga_h))):
-        if rev_h[i] and sga_h[i]:
-            ratio = sga_h[i] / rev_h[i]
-            if ratio < 0.05:
-                corrections.append(
-                    f"sga_hist[{i}] = {sga_h[i]} is only {ratio:.1%} of revenue — likely wrong row, setting null")
-                sga_h[i] = None
-    f["sga_hist"] = sga_h
+    corrections += _null_low_sga(sga_h, rev_h, HIST_YEARS, "sga_hist", "revenue")
 
     # CHECK 2: Add-backs sanity — must be <25% of revenue
     for i in range(min(3, len(adj_b))):
@@ -1086,7 +1113,6 @@ def validate_and_correct(data):
                 corrections.append(
                     f"adjustments_hist[{i}] = {adj_b[i]} exceeds 25% of revenue — likely confusion with EBITDA, setting 0")
                 adj_b[i] = 0
-    f["adjustments_hist"] = adj_b
 
     # CHECK 3: Adj EBITDA must be less than Gross Profit
     for i in range(min(3, len(adj_h))):
@@ -1095,7 +1121,6 @@ def validate_and_correct(data):
                 f"adj_ebitda_hist[{i}] = {adj_h[i]} > gross_profit = {gp_h[i]} — recalculating")
             if sga_h[i]:
                 adj_h[i] = round(gp_h[i] - sga_h[i] + (adj_b[i] or 0), 2)
-    f["adj_ebitda_hist"] = adj_h
 
     # CHECK 4: Depreciation in projections cannot equal EBITDA
     for i in range(min(5, len(dep_p))):
@@ -1106,7 +1131,6 @@ def validate_and_correct(data):
                 corrections.append(
                     f"depreciation_proj[{i}] = {dep_p[i]} ~= adj_ebitda_proj[{i}] = {ebt_p[i]} — copy error, using historical avg {avg_dep}")
                 dep_p[i] = avg_dep
-    f["depreciation_proj"] = dep_p
 
     # CHECK 5: Historical depreciation cannot equal EBITDA
     for i in range(min(3, len(dep_h))):
@@ -1115,7 +1139,6 @@ def validate_and_correct(data):
                 corrections.append(
                     f"depreciation_hist[{i}] = {dep_h[i]} ~= adj_ebitda_hist[{i}] = {adj_h[i]} — likely confused with EBITDA, setting null")
                 dep_h[i] = None
-    f["depreciation_hist"] = dep_h
 
     # CHECK 6: EBITDA margin must be 3-45% of revenue
     for i in range(min(3, len(adj_h))):
@@ -1143,14 +1166,8 @@ def validate_and_correct(data):
     data["rates"] = rates
 
     # CHECK 9: Projection arrays must always be length 5
-    proj_arrays = ["net_revenue_proj", "gross_profit_proj", "sga_proj",
-                   "adjustments_proj", "adj_ebitda_proj", "depreciation_proj",
-                   "capex_proj", "mgmt_fees_proj", "ebitda_margin_proj"]
-    for key in proj_arrays:
-        arr = f.get(key, [])
-        if len(arr) < 5:
-            f[key] = arr + [None] * (5 - len(arr))
-            corrections.append(f"{key} padded to length 5")
+    for key in _pad(f, PROJ_KEYS, PROJ_YEARS):
+        corrections.append(f"{key} padded to length 5")
 
     # projection_years must always be length 5
     proj_yrs = data.get("projection_years", [])
@@ -1163,17 +1180,6 @@ def validate_and_correct(data):
             d["ebitda_for_price"] = adj_h[2]
             corrections.append(f"ebitda_for_price was null — set to adj_ebitda_hist[2] = {adj_h[2]}")
 
-    # purchase_price recalculation
-    if not d.get("purchase_price_calculated"):
-        ebitda_fp = d.get("ebitda_for_price")
-        mult = d.get("entry_multiple")
-        if ebitda_fp and mult:
-            pct = d.get("pct_acquired", 1.0) or 1.0
-            d["purchase_price_calculated"] = round(ebitda_fp * mult * pct, 0)
-            d["enterprise_value"] = d["purchase_price_calculated"]
-            corrections.append(
-                f"purchase_price calculated: {ebitda_fp} x {mult} = {d['purchase_price_calculated']}")
-
     # ── CAPEX VALIDATION ──────────────────────────────────────────
     cap_h = f.get("capex_hist", [])
     cap_p = f.get("capex_proj", [])
@@ -1222,20 +1228,13 @@ def validate_and_correct(data):
             print(f"[CAPEX WARNING] {w}")
 
     # CHECK 12: Projection SG&A sanity — same < 5% threshold as historical
-    sga_p = f.get("sga_proj", [None] * 5)
-    rev_p = f.get("net_revenue_proj", [None] * 5)
-    for i in range(min(5, len(sga_p))):
-        if rev_p[i] and sga_p[i]:
-            ratio_p = sga_p[i] / rev_p[i]
-            if ratio_p < 0.05:
-                corrections.append(
-                    f"sga_proj[{i}] = {sga_p[i]} is only {ratio_p:.1%} of proj revenue — likely wrong row, setting null")
-                sga_p[i] = None
-    f["sga_proj"] = sga_p
+    sga_p = _ensure_list(f, "sga_proj", PROJ_YEARS)
+    rev_p = f.get("net_revenue_proj", _N5)
+    corrections += _null_low_sga(sga_p, rev_p, PROJ_YEARS, "sga_proj", "proj revenue")
 
     data["financials"] = f
     data["deal"] = d
-    # Preserve corrections from earlier pipeline steps (e.g. check_and_fix_row_swaps)
+    # Preserve corrections from earlier pipeline steps (e.g. check_integrity)
     data.setdefault("_corrections_applied", []).extend(corrections)
 
     if corrections:
@@ -1246,90 +1245,51 @@ def validate_and_correct(data):
     return data
 
 
+def _safe_ratio(num, den):
+    """num / den to 4 places, or None when either side is missing or zero."""
+    return round(num / den, 4) if num and den else None
+
+
 def post_process_extraction(raw_json):
-    """Fill in calculated fields and validate key relationships."""
+    """Fill in calculated fields and validate key relationships.
+
+    Expects normalize_shape() to have padded every financials array already.
+    """
     f = raw_json.get("financials", {})
     d = raw_json.get("deal", {})
     c = raw_json.get("collateral", {})
 
-    # Ensure arrays exist with correct lengths
-    for key in ["net_revenue_hist", "gross_profit_hist", "sga_hist",
-                "adjustments_hist", "adj_ebitda_hist", "other_income_hist",
-                "depreciation_hist", "capex_hist"]:
-        arr = f.get(key)
-        if not isinstance(arr, list) or len(arr) < 3:
-            f[key] = (arr or []) + [None] * (3 - len(arr or []))
-
-    for key in ["net_revenue_proj", "gross_profit_proj", "sga_proj",
-                "adjustments_proj", "adj_ebitda_proj", "depreciation_proj",
-                "capex_proj", "mgmt_fees_proj"]:
-        arr = f.get(key)
-        if not isinstance(arr, list) or len(arr) < 5:
-            f[key] = (arr or []) + [None] * (5 - len(arr or []))
-
-    # 1. Calculate purchase price if not present
-    if d.get("purchase_price_calculated") is None:
-        ebitda = d.get("ebitda_for_price")
-        mult = d.get("entry_multiple")
-        pct = d.get("pct_acquired", 1.0) or 1.0
-        if ebitda and mult:
-            d["purchase_price_calculated"] = round(ebitda * mult * pct, 2)
-            if d.get("enterprise_value") is None:
-                d["enterprise_value"] = d["purchase_price_calculated"]
-
-    # 2. Backfill adj_ebitda_hist from components if null
+    # 1. Backfill adj_ebitda_hist from components if null
     # IMPORTANT: Only backfill when adjustments are explicitly known (not null).
     # Using adj=0 when null would produce EBITDA = GP - SGA = Operating Income, which is WRONG.
-    rev = f.get("net_revenue_hist", [None]*3)
-    gp = f.get("gross_profit_hist", [None]*3)
-    sga = f.get("sga_hist", [None]*3)
-    adj = f.get("adjustments_hist", [None]*3)
-    ebitda_hist = f.get("adj_ebitda_hist", [None]*3)
+    rev = f.get("net_revenue_hist", _N3)
+    gp = f.get("gross_profit_hist", _N3)
+    sga = f.get("sga_hist", _N3)
+    adj = f.get("adjustments_hist", _N3)
+    ebitda_hist = _ensure_list(f, "adj_ebitda_hist", HIST_YEARS)
 
     for i in range(min(3, len(ebitda_hist))):
         if ebitda_hist[i] is None and gp[i] is not None and sga[i] is not None and adj[i] is not None:
             ebitda_hist[i] = round(gp[i] - sga[i] + adj[i], 2)
-    f["adj_ebitda_hist"] = ebitda_hist
-
-    # 3. Calculate margins
-    ebitda_margins = []
-    gm_pcts = []
-    for i in range(3):
-        r = rev[i] if i < len(rev) else None
-        e = ebitda_hist[i] if i < len(ebitda_hist) else None
-        g = gp[i] if i < len(gp) else None
-        ebitda_margins.append(round(e / r, 4) if r and e else None)
-        gm_pcts.append(round(g / r, 4) if r and g else None)
-    f["ebitda_margin_hist"] = ebitda_margins
-    f["gm_pct_hist"] = gm_pcts
-
-    # 4. Revenue growth
-    growth = [None]
-    for i in range(1, 3):
-        prev = rev[i - 1] if i - 1 < len(rev) else None
-        curr = rev[i] if i < len(rev) else None
-        if prev and curr and prev != 0:
-            growth.append(round((curr - prev) / prev, 4))
-        else:
-            growth.append(None)
-    f["revenue_growth_hist"] = growth
-
-    # 5. Projection margins
-    rev_p = f.get("net_revenue_proj", [None]*5)
-    ebitda_p = f.get("adj_ebitda_proj", [None]*5)
-    gp_p = f.get("gross_profit_proj", [None]*5)
-    margin_p = []
-    gm_p = []
-    for i in range(5):
-        rp = rev_p[i] if i < len(rev_p) else None
-        ep = ebitda_p[i] if i < len(ebitda_p) else None
-        gpp = gp_p[i] if i < len(gp_p) else None
-        margin_p.append(round(ep / rp, 4) if rp and ep else None)
-        gm_p.append(round(gpp / rp, 4) if rp and gpp else None)
-    f["ebitda_margin_proj"] = margin_p
-    f["gm_pct_proj"] = gm_p
-
-    # 6. ABL availability
+
+    # 2. Calculate margins
+    f["ebitda_margin_hist"] = [_safe_ratio(ebitda_hist[i], rev[i]) for i in range(HIST_YEARS)]
+    f["gm_pct_hist"] = [_safe_ratio(gp[i], rev[i]) for i in range(HIST_YEARS)]
+
+    # 3. Revenue growth
+    f["revenue_growth_hist"] = [None] + [
+        round((rev[i] - rev[i - 1]) / rev[i - 1], 4) if rev[i - 1] and rev[i] else None
+        for i in range(1, HIST_YEARS)
+    ]
+
+    # 4. Projection margins
+    rev_p = f.get("net_revenue_proj", _N5)
+    ebitda_p = f.get("adj_ebitda_proj", _N5)
+    gp_p = f.get("gross_profit_proj", _N5)
+    f["ebitda_margin_proj"] = [_safe_ratio(ebitda_p[i], rev_p[i]) for i in range(PROJ_YEARS)]
+    f["gm_pct_proj"] = [_safe_ratio(gp_p[i], rev_p[i]) for i in range(PROJ_YEARS)]
+
+    # 5. ABL availability
     ar_val = c.get("ar_value")
     ar_rate = c.get("ar_advance_rate", 0.75) or 0.75
     inv_val = c.get("inventory_value")
@@ -1341,14 +1301,14 @@ def post_process_extraction(raw_json):
         avail += inv_val * inv_rate
     c["abl_availability_calculated"] = round(avail, 2) if avail > 0 else None
 
-    # 7. Leverage ratio
+    # 6. Leverage ratio
     term = d.get("term_loan_amount", 0) or 0
     sn = d.get("seller_note_amount", 0) or 0
     ebitda_for_price = d.get("ebitda_for_price")
     if ebitda_for_price and ebitda_for_price > 0:
         d["leverage_ratio"] = round((term + sn) / ebitda_for_price, 2)
 
-    # 8. LTM convenience fields
+    # 7. LTM convenience fields
     d["revenue_ltm"] = rev[2] if len(rev) > 2 and rev[2] else None
     d["ebitda_ltm"] = ebitda_hist[2] if len(ebitda_hist) > 2 and ebitda_hist[2] else None
 
@@ -1358,81 +1318,194 @@ def post_process_extraction(raw_json):
     return raw_json
 
 
-def extract_document_financials(doc_id, ocr_text_path):
-    """Main extraction function. Runs in a background thread after OCR completes."""
+def finalize_extraction(data):
+    """Turn a parsed model reply into the extraction that gets stored."""
+    # 0. SHAPE: pad arrays to 3 hist / 5 proj years before anything indexes them
+    data = normalize_shape(data)
+
+    # 1. INTEGRITY: fix row swaps (EBITDA vs Operating Income confusion)
+    #    and infer missing revenue from GP + known GM%
+    data = check_integrity(data)
+
+    # 2. Post-process: fill calculated fields (margins, growth, ABL, etc.)
+    data = post_process_extraction(data)
+
+    # 3. Validate and auto-correct known extraction bugs
+    data = validate_and_correct(data)
+
+    # 4. Derive missing values from available data
+    data = derive_missing_values(data)
+
+    # 5. Purchase price from the final EBITDA / multiple (CHECK 10 and the
+    #    entry-multiple derivation can both supply an input late)
+    data = _ensure_purchase_price(data)
+
+    return data
+
+
+def _ensure_purchase_price(data):
+    """Fill purchase price as EBITDA x entry multiple x % acquired (and EV when absent)."""
+    d = data.get("deal", {})
+    if d.get("purchase_price_calculated") is not None:
+        return data
+    ebitda_fp = d.get("ebitda_for_price")
+    mult = d.get("entry_multiple")
+    if not (ebitda_fp and mult):
+        return data
+
+    pct = d.get("pct_acquired", 1.0) or 1.0
+    price = d["purchase_price_calculated"] = round(ebitda_fp * mult * pct, 0)
+    # A stated EV wins ("EV if stated, else same as purchase_price")
+    if d.get("enterprise_value") is None:
+        d["enterprise_value"] = price
+    data.setdefault("_derivations_applied", []).append(
+        f"purchase_price derived: {ebitda_fp} x {mult} x {pct} = {price}")
+    data.setdefault("field_sources", {})["purchase_price"] = SRC_DERIVED
+    data["deal"] = d
+    return data
+
+
+@lru_cache(maxsize=1)
+def _init():
+    """Create the output folders once, on the first extraction rather than at import."""
+    os.makedirs(RESPONSE_CACHE_FOLDER, exist_ok=True)  # creates EXTRACTIONS_FOLDER too
+
+
+@lru_cache(maxsize=1)
+def _client():
+    """Shared API client, built on the first uncached call so cache hits don't need a key."""
+    # One pool sized to the concurrency cap, with connections kept warm across
+    # the OCR gap between documents. Retries stay in _call_nvidia_with_retry so
+    # the SDK doesn't back off while holding an _api_slots permit.
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=NVIDIA_MAX_CONCURRENCY,
+        max_keepalive_connections=NVIDIA_MAX_CONCURRENCY,
+        keepalive_expiry=NVIDIA_KEEPALIVE_SECONDS,
+    )
+    return OpenAI(
+        base_url=NVIDIA_BASE_URL,
+        api_key=NVIDIA_API_KEY,
+        max_retries=0,
+        http_client=DefaultHttpxClient(limits=limits),
+    )
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """Tokenizer for budget checks, or None when tiktoken (or its BPE data) is unavailable."""
+    if tiktoken is None:
+        return None
     try:
-        update_document_extraction(doc_id, extraction_status='processing', extraction_error=None)
-        print(f"[EXTRACTION] doc_id={doc_id}: Started AI extraction via NVIDIA NIM")
+        return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        print(f"[EXTRACTION] tiktoken unavailable, estimating tokens from length: {e}")
+        return None
 
-        # Read OCR text
-        full_path = ocr_text_path if os.path.isabs(ocr_text_path) else os.path.join(BASE_DIR, ocr_text_path)
-        with open(full_path, 'r', encoding='utf-8') as f:
-            ocr_text = f.read()
-
-        # Truncate if too long
-        if len(ocr_text) > MAX_TEXT_CHARS:
-            first_chunk = ocr_text[:30000]
-            last_chunk = ocr_text[-20000:]
-            ocr_text = (
-                first_chunk
-                + "\n\n[... MIDDLE SECTION TRUNCATED FOR LENGTH ...]\n\n"
-                + last_chunk
-            )
-            print(f"[EXTRACTION] doc_id={doc_id}: Text truncated to {len(ocr_text)} chars")
 
-        # Call NVIDIA NIM API with retry
-        extraction_json = _call_nvidia_with_retry(ocr_text)
+def _count_tokens(text):
+    enc = _encoding()
+    if enc is None:
+        return len(text) // 4
+    return len(enc.encode_ordinary(text))
 
-        # Parse and validate
-        extraction_data = json.loads(extraction_json)
 
-        # 1. INTEGRITY: fix row swaps (EBITDA vs Operating Income confusion)
-        extraction_data = check_and_fix_row_swaps(extraction_data)
+@lru_cache(maxsize=1)
+def _ocr_token_budget():
+    """Tokens left for OCR text after the prompt, the reply and a safety margin."""
+    prompt_tokens = _count_tokens(SYSTEM_PROMPT) + _count_tokens(USER_MESSAGE_TEMPLATE)
+    return min(MAX_OCR_TOKENS, NVIDIA_CONTEXT_TOKENS - MAX_OUTPUT_TOKENS - prompt_tokens - 512)
 
-        # 2. INTEGRITY: infer missing revenue from GP + known GM%
-        extraction_data = check_revenue_completeness(extraction_data)
 
-        # 3. Post-process: fill calculated fields (margins, growth, ABL, etc.)
-        extraction_data = post_process_extraction(extraction_data)
+def _truncate_to_tokens(text, max_tokens):
+    """Keep the first 60% and last 40% of the budget; returns `text` itself if it fits."""
+    head = max_tokens * 3 // 5
+    tail = max_tokens - head
+    enc = _encoding()
+    if enc is None:
+        if len(text) // 4 <= max_tokens:
+            return text
+        return text[:head * 4] + TRUNCATION_MARKER + text[-tail * 4:]
 
-        # 4. Validate and auto-correct known extraction bugs
-        extraction_data = validate_and_correct(extraction_data)
+    # Every token spans at least one UTF-8 byte, so fitting by byte length is
+    # sufficient (not necessary) and spares encoding text that clearly fits
+    if len(text.encode('utf-8')) <= max_tokens:
+        return text
+    tokens = enc.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:head]) + TRUNCATION_MARKER + enc.decode(tokens[-tail:])
 
-        # 5. Derive missing values from available data
-        extraction_data = derive_missing_values(extraction_data)
 
-        # Save extraction JSON
-        extraction_path = os.path.join(EXTRACTIONS_FOLDER, f'{doc_id}.json')
-        with open(extraction_path, 'w', encoding='utf-8') as f:
-            json.dump(extraction_data, f, indent=2, ensure_ascii=False)
+# Generous heuristic for UTF-8 bytes per token (text averages about 4), used to
+# size the windows read from OCR files too large to send whole. Not a hard
+# bound: pathological text can exceed it, in which case the windows simply
+# hold fewer tokens than the budget allows.
+_WINDOW_BYTES_PER_TOKEN = 16
 
-        # Extract key fields for DB columns
-        deal = extraction_data.get('deal', {})
-        confidence = extraction_data.get('confidence', {})
-        hist_years = extraction_data.get('historical_years', [])
 
-        overall_conf = confidence.get('overall_confidence', 0)
-        # Normalize: if 0-100 scale, convert to 0-1 for DB
-        if isinstance(overall_conf, (int, float)) and overall_conf > 1:
-            overall_conf = overall_conf / 100.0
+def _read_ocr_text(path, max_tokens):
+    """Read an OCR text file, skipping the middle of one far over `max_tokens`.
 
-        update_document_extraction(
-            doc_id,
-            extraction_status='completed',
-            extraction_completed_at=datetime.now(timezone.utc).isoformat(),
-            extraction_path=os.path.join('storage', 'extractions', f'{doc_id}.json'),
-            company_name=extraction_data.get('company_name'),
-            fiscal_year_1=hist_years[0] if len(hist_years) > 0 else None,
-            fiscal_year_2=hist_years[1] if len(hist_years) > 1 else None,
-            fiscal_year_3=hist_years[2] if len(hist_years) > 2 else None,
-            ebitda_ltm=deal.get('ebitda_ltm'),
-            revenue_ltm=deal.get('revenue_ltm'),
-            entry_multiple=deal.get('entry_multiple'),
-            purchase_price=deal.get('purchase_price_calculated'),
-            confidence_score=overall_conf,
-        )
+    An oversized file yields just enough of its start and end for
+    _truncate_to_tokens to take its 60% / 40% split from, so the part it would
+    drop is never read or decoded.
+    """
+    head = max_tokens * 3 // 5 * _WINDOW_BYTES_PER_TOKEN
+    tail = max_tokens * _WINDOW_BYTES_PER_TOKEN - head
+    if os.path.getsize(path) <= head + tail:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    with open(path, 'rb') as f:
+        data = f.read(head)
+        f.seek(-tail, os.SEEK_END)
+        # Mark the skipped middle, as _truncate_to_tokens does, in case the
+        # windows already fit and are returned unchanged
+        data += TRUNCATION_MARKER.encode('utf-8') + f.read(tail)
+    # The cut points can split a multi-byte character; drop the fragments
+    return data.decode('utf-8', errors='ignore')
+
+
+def _response_cache_path(ocr_text):
+    """Cache file for the model reply to `ocr_text` (whitespace-insensitive)."""
+    digest = hashlib.sha256(_RESPONSE_CACHE_SALT)
+    digest.update(' '.join(ocr_text.split()).encode('utf-8'))
+    return _response_cache.path(digest.hexdigest())
+
+
+def _read_cached_response(path):
+    data = _response_cache.read(path)
+    if data is None:
+        return None
+    try:
+        response_data = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        response_data = None
+    if not isinstance(response_data, dict):
+        # Corrupt entry: treat as a miss; the fresh reply overwrites it
+        print(f"[EXTRACTION CACHE] ignoring {path}: not a JSON object")
+        return None
+    return response_data
+
+
+def _write_cached_response(path, response_data):
+    _response_cache.write(path, orjson.dumps(response_data))
+
+
+def extract_document_financials(doc_id, ocr_text_path, use_cache=True):
+    """Main extraction function. Runs in a background thread after OCR completes.
+
+    With use_cache=False the model is always called (e.g. an explicit re-extract)
+    and its reply replaces any cached one.
+    """
+    try:
+        _init()
+        update_document_extraction(doc_id, extraction_status='processing', extraction_error=None)
+        print(f"[EXTRACTION] doc_id={doc_id}: Started AI extraction via NVIDIA NIM")
 
-        print(f"[EXTRACTION] doc_id={doc_id}: Completed — company={extraction_data.get('company_name')}, confidence={overall_conf:.0%}")
+        extraction_data = _fetch_extraction(doc_id, ocr_text_path, use_cache)
+        extraction_data = finalize_extraction(extraction_data)
+        _store_extraction(doc_id, extraction_data)
 
     except Exception as e:
         print(f"[EXTRACTION ERROR] doc_id={doc_id}: {e}")
@@ -1445,55 +1518,167 @@ def extract_document_financials(doc_id, ocr_text_path):
         )
 
 
-def _call_nvidia_with_retry(ocr_text, max_retries=3):
-    """Call NVIDIA NIM API (OpenAI-compatible) with exponential backoff retry."""
-    client = OpenAI(
-        base_url=NVIDIA_BASE_URL,
-        api_key=NVIDIA_API_KEY,
+def _fetch_extraction(doc_id, ocr_text_path, use_cache):
+    """Parsed model reply for the document's OCR text (the I/O-bound half)."""
+    # Read OCR text (only the ends of a file far over the token budget)
+    full_path = ocr_text_path if os.path.isabs(ocr_text_path) else os.path.join(BASE_DIR, ocr_text_path)
+    budget = _ocr_token_budget()
+    ocr_text = _read_ocr_text(full_path, budget)
+
+    # Truncate if too long for the token budget
+    truncated = _truncate_to_tokens(ocr_text, budget)
+    if truncated is not ocr_text:
+        ocr_text = truncated
+        print(f"[EXTRACTION] doc_id={doc_id}: Text truncated to {len(ocr_text)} chars")
+
+    # Call NVIDIA NIM API with retry, unless this exact text was already extracted
+    cache_path = _response_cache_path(ocr_text)
+    extraction_data = _read_cached_response(cache_path) if use_cache else None
+    if extraction_data is not None:
+        print(f"[EXTRACTION] doc_id={doc_id}: Reusing cached model response")
+    else:
+        extraction_data = _call_nvidia_with_retry(ocr_text)
+        _write_cached_response(cache_path, extraction_data)
+    return extraction_data
+
+
+def _store_extraction(doc_id, extraction_data):
+    """Write the finished extraction to disk and mark the document completed."""
+    # Save extraction JSON (compact and gzipped; the repeated labels compress
+    # well and the API can hand the bytes straight to gzip-capable clients)
+    extraction_path = os.path.join(EXTRACTIONS_FOLDER, f'{doc_id}.json.gz')
+    with gzip.open(extraction_path, 'wb') as f:
+        f.write(orjson.dumps(extraction_data, option=orjson.OPT_NON_STR_KEYS))
+
+    # Drop an uncompressed copy left by an extraction from before the switch
+    try:
+        os.remove(os.path.join(EXTRACTIONS_FOLDER, f'{doc_id}.json'))
+    except FileNotFoundError:
+        pass
+
+    # Extract key fields for DB columns
+    deal = extraction_data.get('deal', {})
+    confidence = extraction_data.get('confidence', {})
+    hist_years = extraction_data.get('historical_years', [])
+
+    overall_conf = confidence.get('overall_confidence', 0)
+    # Normalize: if 0-100 scale, convert to 0-1 for DB
+    if isinstance(overall_conf, (int, float)) and overall_conf > 1:
+        overall_conf = overall_conf / 100.0
+
+    update_document_extraction(
+        doc_id,
+        extraction_status='completed',
+        extraction_completed_at=utc_now_iso(),
+        extraction_path=os.path.join('storage', 'extractions', f'{doc_id}.json.gz'),
+        company_name=extraction_data.get('company_name'),
+        fiscal_year_1=hist_years[0] if len(hist_years) > 0 else None,
+        fiscal_year_2=hist_years[1] if len(hist_years) > 1 else None,
+        fiscal_year_3=hist_years[2] if len(hist_years) > 2 else None,
+        ebitda_ltm=deal.get('ebitda_ltm'),
+        revenue_ltm=deal.get('revenue_ltm'),
+        entry_multiple=deal.get('entry_multiple'),
+        purchase_price=deal.get('purchase_price_calculated'),
+        confidence_score=overall_conf,
     )
 
+    print(f"[EXTRACTION] doc_id={doc_id}: Completed — company={extraction_data.get('company_name')}, confidence={overall_conf:.0%}")
+
+
+# ```json ... ``` wrapper some models put around the object. An unclosed fence
+# doesn't match and is left to _parse_json_object's brace slice.
+_FENCE_RE = re.compile(r'^```[^\n]*\n(.*?)\n?```$', re.DOTALL)
+
+
+class ReplyTruncatedError(ValueError):
+    """The model stopped at max_tokens, so its JSON is incomplete."""
+
+
+def _call_nvidia_with_retry(ocr_text, max_retries=3):
+    """Call NVIDIA NIM API (OpenAI-compatible) with exponential backoff retry; returns the parsed reply."""
+    client = _client()
+    messages = [_SYSTEM_MSG, {"role": "user", "content": _USER_PREFIX + ocr_text + _USER_SUFFIX}]
+
     last_exception = None
     for attempt in range(max_retries):
         try:
-            completion = client.chat.completions.create(
-                model=NVIDIA_MODEL,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": USER_MESSAGE_TEMPLATE.format(ocr_text=ocr_text)}
-                ],
-                temperature=0.1,
-                top_p=0.9,
-                max_tokens=8192,
-                stream=True,
-            )
+            # Hold a slot only while the request is in flight, not during backoff
+            with _api_slots:
+                completion = client.chat.completions.create(
+                    model=NVIDIA_MODEL,
+                    messages=messages,
+                    temperature=0.1,
+                    top_p=0.9,
+                    max_tokens=MAX_OUTPUT_TOKENS,
+                    stream=True,
+                    response_format=RESPONSE_FORMAT if NVIDIA_STRUCTURED_OUTPUT else NOT_GIVEN,
+                    extra_body={'prompt_cache_key': _PROMPT_CACHE_KEY} if NVIDIA_PROMPT_CACHE else None,
+                )
 
-            response_text = ""
-            for chunk in completion:
-                if not getattr(chunk, "choices", None):
-                    continue
-                if chunk.choices and chunk.choices[0].delta.content is not None:
-                    response_text += chunk.choices[0].delta.content
+                parts = []
+                finish_reason = None
+                for chunk in completion:
+                    if not getattr(chunk, "choices", None):
+                        continue
+                    choice = chunk.choices[0]
+                    content = choice.delta.content
+                    if content is not None:
+                        parts.append(content)
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+                response_text = "".join(parts)
 
             print(f"[EXTRACTION] NVIDIA response length: {len(response_text)} chars")
 
+            # A reply cut off at max_tokens can't parse, and asking again gets the same cut
+            if finish_reason == 'length':
+                raise ReplyTruncatedError(
+                    f"Model reply was cut off at max_tokens={MAX_OUTPUT_TOKENS} "
+                    f"({len(response_text)} chars received)"
+                )
+
             # Strip markdown code fences if present
             response_text = response_text.strip()
-            if response_text.startswith('```'):
-                lines = response_text.split('\n')
-                lines = lines[1:]
-                if lines and lines[-1].strip() == '```':
-                    lines = lines[:-1]
-                response_text = '\n'.join(lines)
+            fenced = _FENCE_RE.match(response_text)
+            if fenced:
+                response_text = fenced.group(1)
 
-            # Validate it's valid JSON
-            json.loads(response_text)
-            return response_text
+            return _parse_json_object(response_text)
 
+        except ReplyTruncatedError:
+            raise
         except Exception as e:
             last_exception = e
             if attempt < max_retries - 1:
                 delay = 2 ** (attempt + 1)
+                if isinstance(e, RateLimitError):
+                    # 429: wait as long as the server asks, else back off harder
+                    delay = _retry_after_seconds(e) or delay * 4
                 print(f"[EXTRACTION RETRY] attempt {attempt + 1}/{max_retries}, retrying in {delay}s: {e}")
                 time.sleep(delay)
 
     raise last_exception
+
+
+def _parse_json_object(text):
+    """Parse `text`, falling back to its outermost {...} slice.
+
+    Covers replies with a sentence of preamble or trailing commentary around
+    the object; anything else raises orjson.JSONDecodeError for a retry.
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        start = text.find('{')
+        end = text.rfind('}')
+        if start == -1 or end <= start or (start == 0 and end == len(text) - 1):
+            raise
+    return orjson.loads(text[start:end + 1])
+
+
+def _retry_after_seconds(error):
+    """Seconds from a 429's Retry-After header, or None if absent/unparseable."""
+    try:
+        return float(error.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
@@ -1,15 +1,22 @@
 import os
 import io
+import gzip
+import orjson
 import time
-from datetime import datetime, timezone
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from google.api_core import exceptions as gexc
 from google.cloud import documentai_v1 as documentai
-from google.protobuf.json_format import MessageToJson
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.message import DecodeError
 from pypdf import PdfReader, PdfWriter
 from dotenv import load_dotenv
 
-import threading
-from database import update_document_ocr_status
+from database import update_document_ocr_status, utc_now_iso
+from services.disk_cache import DiskCache
 
 load_dotenv()
 
@@ -28,115 +35,160 @@ if creds_path and not os.path.isabs(creds_path):
 OCR_RAW_FOLDER = os.path.join(BASE_DIR, os.getenv('OCR_RAW_FOLDER', 'storage/ocr/raw'))
 OCR_PROCESSED_FOLDER = os.path.join(BASE_DIR, os.getenv('OCR_PROCESSED_FOLDER', 'storage/ocr/processed'))
 
+# Output file names and the repo-relative paths stored in the DB, built once
+_RAW_NAME = '{}.ndjson.gz'.format
+_TXT_NAME = '{}.txt'.format
+_RAW_REL = os.path.join('storage', 'ocr', 'raw', '{}.ndjson.gz').format
+_TXT_REL = os.path.join('storage', 'ocr', 'processed', '{}.txt').format
+
+# Document AI responses keyed by a hash of the chunk bytes, so re-uploads of
+# the same file skip the API; least recently used entries go past the cap
+OCR_CACHE_FOLDER = os.path.join(OCR_RAW_FOLDER, '_cache')
+OCR_CACHE_MAX_BYTES = int(os.getenv('OCR_CACHE_MAX_MB', '2048')) * 1024 * 1024
+
 MAX_INLINE_SIZE = 15 * 1024 * 1024  # 15MB
 MAX_PAGES_PER_REQUEST = 15
 
+# Transient Document AI failures worth retrying; anything else (bad request,
+# auth, permission) fails the chunk immediately
+RETRIABLE_ERRORS = (
+    gexc.ServiceUnavailable, gexc.DeadlineExceeded,
+    gexc.ResourceExhausted, gexc.InternalServerError,
+)
+
+# Chunk requests in flight per document; bounded by the Document AI project quota
+OCR_CONCURRENCY = max(1, int(os.getenv('OCR_CONCURRENCY', '4')))
+
 os.makedirs(OCR_RAW_FOLDER, exist_ok=True)
 os.makedirs(OCR_PROCESSED_FOLDER, exist_ok=True)
+os.makedirs(OCR_CACHE_FOLDER, exist_ok=True)
+
+_ocr_cache = DiskCache(OCR_CACHE_FOLDER, '.pb', OCR_CACHE_MAX_BYTES, 'OCR CACHE')
+
+# Bounded pools for background work so batch uploads queue instead of
+# oversubscribing threads and the Document AI / model quotas
+_OCR_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv('OCR_WORKERS') or os.cpu_count() or 4), thread_name_prefix='ocr')
+_EXTRACT_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv('EXTRACTION_WORKERS') or os.getenv('NVIDIA_MAX_CONCURRENCY') or 4),
+    thread_name_prefix='extract')
+
+_PROCESSOR_NAME = documentai.DocumentProcessorServiceClient.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
+
+# One client (credentials + gRPC channel) shared by every chunk and document;
+# created lazily so importing the module never touches the network
+_client = None
+_client_lock = threading.Lock()
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = documentai.DocumentProcessorServiceClient()
+    return _client
 
 
 def process_document_ocr(doc_id, pdf_path):
-    """Main OCR processing function. Runs in a background thread."""
+    """Main OCR processing function. Runs on the OCR pool (see submit_ocr)."""
     try:
         # a) Mark as processing
         update_document_ocr_status(doc_id, 'processing')
         print(f"[OCR] doc_id={doc_id}: Processing started")
 
-        # b) Read PDF and count pages
-        reader = PdfReader(pdf_path)
+        # b) Read PDF once and count pages
+        with open(pdf_path, 'rb') as f:
+            pdf_data = f.read()
+        reader = PdfReader(io.BytesIO(pdf_data))
         total_pages = len(reader.pages)
         print(f"[OCR] doc_id={doc_id}: PDF has {total_pages} pages")
 
-        # c) Split into chunks if needed, process each
+        # c) Split into chunks if needed. A PDF that already fits one request
+        #    is sent as uploaded, skipping the pypdf rewrite entirely.
+        if 0 < total_pages <= MAX_PAGES_PER_REQUEST and len(pdf_data) <= MAX_INLINE_SIZE:
+            chunks = [(0, total_pages, pdf_data)]
+        else:
+            chunks = _split_pdf(reader, total_pages)
+
+        # d) Call Document AI for all chunks concurrently (network-bound), then
+        #    restore page order before assembling output
         all_documents = []
-        all_raw_json = []
-
-        for chunk_start in range(0, total_pages, MAX_PAGES_PER_REQUEST):
-            chunk_end = min(chunk_start + MAX_PAGES_PER_REQUEST, total_pages)
-            print(f"[OCR] doc_id={doc_id}: Processing pages {chunk_start + 1}-{chunk_end}")
-
-            # Extract chunk as PDF bytes
-            writer = PdfWriter()
-            for i in range(chunk_start, chunk_end):
-                writer.add_page(reader.pages[i])
-
-            chunk_buffer = io.BytesIO()
-            writer.write(chunk_buffer)
-            chunk_bytes = chunk_buffer.getvalue()
-
-            # Check size
-            if len(chunk_bytes) > MAX_INLINE_SIZE:
-                raise ValueError(
-                    f"PDF chunk (pages {chunk_start + 1}-{chunk_end}) is {len(chunk_bytes)} bytes, "
-                    "exceeds 15MB inline limit. GCS-based processing not yet supported."
-                )
-
-            # Call Document AI
-            document = _call_document_ai_with_retry(chunk_bytes)
-            all_documents.append((chunk_start, document))
-            all_raw_json.append(MessageToJson(document._pb))
-
-        # e) Save raw JSON response (all chunks)
-        raw_path = os.path.join(OCR_RAW_FOLDER, f'{doc_id}.json')
-        with open(raw_path, 'w', encoding='utf-8') as f:
-            if len(all_raw_json) == 1:
-                f.write(all_raw_json[0])
-            else:
-                f.write('[\n' + ',\n'.join(all_raw_json) + '\n]')
-
-        # f) Extract clean text from all chunks
-        all_text_parts = []
+        with ThreadPoolExecutor(max_workers=max(1, min(OCR_CONCURRENCY, len(chunks)))) as ex:
+            futures = {}
+            for chunk_start, chunk_end, chunk_bytes in chunks:
+                print(f"[OCR] doc_id={doc_id}: Processing pages {chunk_start + 1}-{chunk_end}")
+                futures[ex.submit(_call_document_ai_with_retry, chunk_bytes)] = chunk_start
+            for future in as_completed(futures):
+                all_documents.append((futures[future], future.result()))
+        all_documents.sort(key=lambda item: item[0])
+        # e) Save raw JSON response: one compact line per chunk (NDJSON), so no
+        #    chunk's JSON outlives its own write. Gzipped at a fast level; the
+        #    token/vertex JSON shrinks several-fold.
+        raw_path = os.path.join(OCR_RAW_FOLDER, _RAW_NAME(doc_id))
+        with gzip.open(raw_path, 'wb', compresslevel=3) as f:
+            for _, document in all_documents:
+                f.write(orjson.dumps(MessageToDict(document._pb), option=orjson.OPT_APPEND_NEWLINE))
+
+        # f/g) Extract clean text from all chunks and save it, streaming each
+        #      page to the processed file instead of joining the whole document
+        processed_path = os.path.join(OCR_PROCESSED_FOLDER, _TXT_NAME(doc_id))
         total_confidence = 0.0
         confidence_count = 0
-
-        for chunk_start, document in all_documents:
-            for page in document.pages:
-                # Adjust page number for chunked processing
-                actual_page_num = chunk_start + page.page_number
-                page_parts = [f"=== PAGE {actual_page_num} ==="]
-
-                table_texts = []
-                for table in page.tables:
-                    table_text = _format_table(table, document.text)
-                    table_texts.append(f"[TABLE - Page {actual_page_num}]\n{table_text}")
-
-                for paragraph in page.paragraphs:
-                    text = _get_layout_text(paragraph.layout, document.text)
-                    if text.strip():
-                        page_parts.append(text.strip())
-
-                for tt in table_texts:
-                    page_parts.append(tt)
-
-                all_text_parts.append('\n\n'.join(page_parts))
-
-            # Accumulate confidence from this chunk
-            for page in document.pages:
-                for token in page.tokens:
-                    conf = token.layout.confidence
-                    if conf > 0:
-                        total_confidence += conf
-                        confidence_count += 1
-
-        extracted_text = '\n\n'.join(all_text_parts)
-
-        # g) Save processed text
-        processed_path = os.path.join(OCR_PROCESSED_FOLDER, f'{doc_id}.txt')
-        with open(processed_path, 'w', encoding='utf-8') as f:
-            f.write(extracted_text)
+        word_count = 0
+        page_sep = ''
+
+        with open(processed_path, 'w', encoding='utf-8', buffering=1 << 20) as out:
+            for chunk_start, document in all_documents:
+                # Walk the raw protobuf: the proto-plus wrappers build a Python
+                # proxy on every attribute access. Read text once, since each
+                # access copies the whole string out of the message.
+                doc_pb = document._pb
+                full_text = doc_pb.text
+                for page in doc_pb.pages:
+                    # Adjust page number for chunked processing
+                    actual_page_num = chunk_start + page.page_number
+                    page_parts = [f"=== PAGE {actual_page_num} ==="]
+
+                    table_texts = []
+                    for table in page.tables:
+                        table_text = _format_table(table, full_text)
+                        table_texts.append(f"[TABLE - Page {actual_page_num}]\n{table_text}")
+
+                    for paragraph in page.paragraphs:
+                        text = _get_layout_text(paragraph.layout, full_text)
+                        if text.strip():
+                            page_parts.append(text.strip())
+
+                    for tt in table_texts:
+                        page_parts.append(tt)
+
+                    page_text = '\n\n'.join(page_parts)
+                    out.write(page_sep)
+                    out.write(page_text)
+                    page_sep = '\n\n'
+                    # Pages are whitespace-separated, so per-page counts sum to the whole-text count
+                    word_count += len(page_text.split())
+
+                    # Accumulate token confidence in the same pass over the page
+                    for token in page.tokens:
+                        conf = token.layout.confidence
+                        if conf > 0:
+                            total_confidence += conf
+                            confidence_count += 1
 
         # h) Calculate stats
         page_count = total_pages
-        word_count = len(extracted_text.split())
         ocr_confidence = (total_confidence / confidence_count) if confidence_count > 0 else 0.0
 
         # i) Update DB — completed
+        processed_text_rel = _TXT_REL(doc_id)
         update_document_ocr_status(
             doc_id, 'completed',
             status='analyzed',
-            ocr_completed_at=datetime.now(timezone.utc).isoformat(),
-            raw_ocr_path=os.path.join('storage', 'ocr', 'raw', f'{doc_id}.json'),
-            processed_text_path=os.path.join('storage', 'ocr', 'processed', f'{doc_id}.txt'),
+            ocr_completed_at=utc_now_iso(),
+            raw_ocr_path=_RAW_REL(doc_id),
+            processed_text_path=processed_text_rel,
             page_count=page_count,
             word_count=word_count,
             ocr_confidence=round(ocr_confidence, 4),
@@ -144,7 +196,6 @@ def process_document_ocr(doc_id, pdf_path):
         print(f"[OCR] doc_id={doc_id}: Completed — {page_count} pages, {word_count} words, confidence={ocr_confidence:.2%}")
 
         # Chain AI extraction after successful OCR
-        processed_text_rel = os.path.join('storage', 'ocr', 'processed', f'{doc_id}.txt')
         _start_extraction(doc_id, processed_text_rel)
 
     except Exception as e:
@@ -157,78 +208,140 @@ def process_document_ocr(doc_id, pdf_path):
         )
 
 
+def _split_pdf(reader, total_pages):
+    """Split the PDF into (start, end, bytes) chunks that fit one inline request."""
+    chunks = []
+    for chunk_start in range(0, total_pages, MAX_PAGES_PER_REQUEST):
+        chunk_end = min(chunk_start + MAX_PAGES_PER_REQUEST, total_pages)
+        _append_chunk(chunks, reader, chunk_start, chunk_end)
+    return chunks
+
+
+def _append_chunk(chunks, reader, chunk_start, chunk_end):
+    """Append pages [chunk_start, chunk_end) as one chunk, halving the range until it fits MAX_INLINE_SIZE."""
+    # Extract chunk as PDF bytes (one range copy; the view avoids
+    # duplicating the buffer until the request is built)
+    writer = PdfWriter()
+    writer.append(reader, pages=(chunk_start, chunk_end), import_outline=False)
+
+    chunk_buffer = io.BytesIO()
+    writer.write(chunk_buffer)
+    del writer
+    chunk_bytes = chunk_buffer.getbuffer()
+
+    # Check size
+    if len(chunk_bytes) > MAX_INLINE_SIZE:
+        if chunk_end - chunk_start > 1:
+            del chunk_bytes
+            mid = (chunk_start + chunk_end) // 2
+            _append_chunk(chunks, reader, chunk_start, mid)
+            _append_chunk(chunks, reader, mid, chunk_end)
+            return
+        raise ValueError(
+            f"PDF page {chunk_start + 1} is {len(chunk_bytes)} bytes, "
+            "exceeds 15MB inline limit. GCS-based processing not yet supported."
+        )
+    chunks.append((chunk_start, chunk_end, chunk_bytes))
+
+
 def _call_document_ai_with_retry(pdf_bytes, max_retries=3):
-    """Call Google Document AI with exponential backoff retry."""
-    client = documentai.DocumentProcessorServiceClient()
-    name = client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
+    """Call Google Document AI with exponential backoff retry, via the response cache."""
+    cache_path = _ocr_cache_path(pdf_bytes)
+    document = _read_cached_document(cache_path)
+    if document is not None:
+        return document
 
+    client = _get_client()
     request = documentai.ProcessRequest(
-        name=name,
+        name=_PROCESSOR_NAME,
         raw_document=documentai.RawDocument(
-            content=pdf_bytes,
+            content=bytes(pdf_bytes),
             mime_type='application/pdf',
         ),
     )
 
-    last_exception = None
     for attempt in range(max_retries):
         try:
             result = client.process_document(request=request)
-            return result.document
-        except Exception as e:
-            last_exception = e
-            if attempt < max_retries - 1:
-                delay = 2 ** (attempt + 1)  # 2s, 4s, 8s
-                print(f"[OCR RETRY] attempt {attempt + 1}/{max_retries}, retrying in {delay}s: {e}")
-                time.sleep(delay)
+            break
+        except RETRIABLE_ERRORS as e:
+            if attempt == max_retries - 1:
+                raise
+            # Full jitter so chunks/documents that failed together don't retry in lockstep
+            delay = min(60.0, random.uniform(1.0, 2 ** (attempt + 2)))
+            print(f"[OCR RETRY] attempt {attempt + 1}/{max_retries}, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+    _write_cached_document(cache_path, result.document)
+    return result.document
+
+
+def _ocr_cache_path(pdf_bytes):
+    digest = hashlib.sha256(_PROCESSOR_NAME.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(pdf_bytes)
+    return _ocr_cache.path(digest.hexdigest())
+
+
+def _read_cached_document(path):
+    data = _ocr_cache.read(path)
+    if data is None:
+        return None
+    try:
+        return documentai.Document.deserialize(data)
+    except DecodeError as e:
+        # Corrupt entry: treat as a miss; the fresh response overwrites it
+        print(f"[OCR CACHE] ignoring {path}: {e}")
+        return None
 
-    raise last_exception
+
+def _write_cached_document(path, document):
+    _ocr_cache.write(path, documentai.Document.serialize(document))
 
 
 def _format_table(table, full_text):
-    """Format a Document AI table as a markdown pipe-delimited table."""
+    """Format a raw protobuf Document AI table as a markdown pipe-delimited table."""
     rows = []
 
-    if table.header_rows:
-        for header_row in table.header_rows:
-            cells = []
-            for cell in header_row.cells:
-                cell_text = _get_layout_text(cell.layout, full_text).strip().replace('\n', ' ')
-                cells.append(cell_text)
-            rows.append('| ' + ' | '.join(cells) + ' |')
-            rows.append('| ' + ' | '.join('------' for _ in cells) + ' |')
+    for header_row in table.header_rows:
+        cells = _row_cells(header_row, full_text)
+        rows.append(f"| {' | '.join(cells)} |")
+        rows.append(f"| {' | '.join(['------'] * len(cells))} |")
 
     for body_row in table.body_rows:
-        cells = []
-        for cell in body_row.cells:
-            cell_text = _get_layout_text(cell.layout, full_text).strip().replace('\n', ' ')
-            cells.append(cell_text)
-        rows.append('| ' + ' | '.join(cells) + ' |')
+        rows.append(f"| {' | '.join(_row_cells(body_row, full_text))} |")
 
     return '\n'.join(rows)
 
 
+def _row_cells(row, full_text):
+    # str.replace beats translate() for a single character
+    return [_get_layout_text(cell.layout, full_text).strip().replace('\n', ' ') for cell in row.cells]
+
+
 def _get_layout_text(layout, full_text):
-    """Extract text from a layout element using text anchors."""
-    if not layout.text_anchor or not layout.text_anchor.text_segments:
-        return ''
+    """Extract text from a raw protobuf layout element using text anchors."""
+    # Unset start_index reads as 0; no segments yields ''
+    segments = layout.text_anchor.text_segments
+    if len(segments) == 1:
+        # The common case: one slice, no generator or join
+        segment = segments[0]
+        return full_text[segment.start_index:segment.end_index]
+    return ''.join(full_text[segment.start_index:segment.end_index] for segment in segments)
 
-    parts = []
-    for segment in layout.text_anchor.text_segments:
-        start = int(segment.start_index) if segment.start_index else 0
-        end = int(segment.end_index)
-        parts.append(full_text[start:end])
 
-    return ''.join(parts)
+def submit_ocr(doc_id, pdf_path):
+    """Queue OCR (and the extraction chained after it) for a document; returns its Future."""
+    return _OCR_POOL.submit(process_document_ocr, doc_id, pdf_path)
 
 
-def _start_extraction(doc_id, processed_text_path):
-    """Launch AI extraction in a new background thread."""
+def submit_extraction(doc_id, processed_text_path, use_cache=True):
+    """Queue AI extraction for a document whose OCR text is on disk; returns its Future."""
     from services.extraction_service import extract_document_financials
-    thread = threading.Thread(
-        target=extract_document_financials,
-        args=(doc_id, processed_text_path),
-        daemon=True
-    )
-    thread.start()
-    print(f"[OCR] doc_id={doc_id}: AI extraction thread started")
+    return _EXTRACT_POOL.submit(extract_document_financials, doc_id, processed_text_path, use_cache)
+
+
+def _start_extraction(doc_id, processed_text_path):
+    """Launch AI extraction on the background extraction pool."""
+    submit_extraction(doc_id, processed_text_path)
+    print(f"[OCR] doc_id={doc_id}: AI extraction queued")